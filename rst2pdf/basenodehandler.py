@@ -19,9 +19,9 @@ NodeHandler subclass to use to process an instance of a given
 docutils node class.
 
 When an instance of createpdf.RstToPdf is created, a NodeHandler
-instance will be called to return dispatchers for gather_elements
-and gather_pdftext, wrapped up as methods of the createpdf.RstToPdf
-class.
+instance will be called to return dispatchers for gather_elements,
+gather_pdftext and gather_pdftokens, wrapped up as methods of the
+createpdf.RstToPdf class.
 
 When a dispatcher is called, it will dispatch to the correct subclass
 to handle the given docutils node instance.
@@ -33,14 +33,23 @@ will be logged.
 
 from copy import copy
 import inspect
+import logging
 import types
 
 import docutils.nodes
 from docutils.utils import smartquotes
 
 from .flowables import BoundByWidth, TocEntry
+from .fragments import educate_tokens, markup_tokens, tag_tokens
 from .log import log, nodeid
 
+# Nodes whose text gets smartypants applied
+smarty_nodes = (
+    docutils.nodes.paragraph,
+    docutils.nodes.block_quote,
+    docutils.nodes.title,
+)
+
 
 class MetaHelper(type):
     """MetaHelper is designed to generically enable a few of the benefits of
@@ -170,14 +179,15 @@ class NodeHandler(metaclass=MetaHelper):
                 log.debug(repr(node))
 
     def findsubclass(self, node, during):
-        handlerinfo = '%s.%s' % (self.getclassname(self), during)
-        log.debug("%s: %s", handlerinfo, self.getclassname(node))
-        log.debug("%s: [%s]", handlerinfo, nodeid(node))
-        try:
-            log.debug("%s: %s", handlerinfo, node)
-        except (UnicodeDecodeError, UnicodeEncodeError):
-            log.debug("%s: %r", handlerinfo, node)
-        log.debug("")
+        if log.isEnabledFor(logging.DEBUG):
+            handlerinfo = '%s.%s' % (self.getclassname(self), during)
+            log.debug("%s: %s", handlerinfo, self.getclassname(node))
+            log.debug("%s: [%s]", handlerinfo, nodeid(node))
+            try:
+                log.debug("%s: %s", handlerinfo, node)
+            except (UnicodeDecodeError, UnicodeEncodeError):
+                log.debug("%s: %r", handlerinfo, node)
+            log.debug("")
 
         # Dispatch to the first matching class in the MRO
 
@@ -195,7 +205,8 @@ class NodeHandler(metaclass=MetaHelper):
         '''Get the dispatchers, wrapped up as methods for the client'''
         textdispatch = types.MethodType(self.textdispatch, client)
         elemdispatch = types.MethodType(self.elemdispatch, client)
-        return textdispatch, elemdispatch
+        tokendispatch = types.MethodType(self.tokendispatch, client)
+        return textdispatch, elemdispatch, tokendispatch
 
     # This overridable attribute will be set true in the instance
     # if handling a sphinx document
@@ -264,20 +275,26 @@ class NodeHandler(metaclass=MetaHelper):
 
     def elemdispatch(self, client, node, style=None):
         self = self.findsubclass(node, 'elemdispatch')
-
-        # set anchors for internal references
+        profile = client.handler_profile
+        if profile is not None:
+            profile.enter(self, node, 'elements')
         try:
-            for i in node['ids']:
-                client.pending_targets.append(i)
-        except TypeError:  # Happens with docutils.node.Text
-            pass
+            # set anchors for internal references
+            try:
+                for i in node['ids']:
+                    client.pending_targets.append(i)
+            except TypeError:  # Happens with docutils.node.Text
+                pass
 
-        elements = self.getelements(client, node, style)
+            elements = self.getelements(client, node, style)
 
-        if node.line and client.debugLinesPdf:
-            elements.insert(0, TocEntry(client.depth - 1, 'LINE-%s' % node.line))
-        node.elements = elements
-        return elements
+            if node.line and client.debugLinesPdf:
+                elements.insert(0, TocEntry(client.depth - 1, 'LINE-%s' % node.line))
+            node.elements = elements
+            return elements
+        finally:
+            if profile is not None:
+                profile.leave()
 
     # Begin overridable attributes and methods for textdispatch
 
@@ -292,27 +309,68 @@ class NodeHandler(metaclass=MetaHelper):
 
     def apply_replacements(self, text, smarty, node):
         # Try to be clever about when to replace characters
-        if node.__class__ in (
-            docutils.nodes.paragraph,
-            docutils.nodes.block_quote,
-            docutils.nodes.title,
-        ):
+        if node.__class__ in smarty_nodes:
             return smartquotes.smartyPants(text, smarty)
         return text
 
     # End overridable attributes and methods for textdispatch
 
     def textdispatch(self, client, node, replaceEnt=True):
-        self = self.findsubclass(node, 'textdispatch')
-        pre, post = self.get_pre_post(client, node, replaceEnt)
-        text = self.get_text(client, node, replaceEnt)
-        text = pre + text + post
-
-        try:
-            log.debug("%s.textdispatch: %s" % (self.getclassname(self), text))
-        except UnicodeDecodeError:
-            pass
-
-        text = self.apply_replacements(text, client.smartypants_attributes, node)
+        text = ''.join(self.tokendispatch(client, node, replaceEnt))
         node.pdftext = text
         return text
+
+    def add_tokens(self, client, node, replaceEnt, tokens):
+        # Handlers that only wrap their children add the children's
+        # tokens, anything else is split out of the markup it returns.
+        if type(self).get_text is NodeHandler.get_text:
+            for child in node.children:
+                client.gen_pdftokens(child, replaceEnt, tokens)
+        else:
+            tokens.extend(markup_tokens(self.get_text(client, node, replaceEnt)))
+
+    def tokendispatch(self, client, node, replaceEnt=True, tokens=None):
+        '''Like textdispatch, but return the markup as a list of tokens.
+
+        Tags and text are kept apart (see fragments.markup_tokens), so
+        paragraphs can be built without parsing the markup again. The
+        whole subtree is added to the same list, tokens if given, so
+        no text is copied once per level of nesting.
+        '''
+        if tokens is None:
+            tokens = []
+        self = self.findsubclass(node, 'tokendispatch')
+        profile = client.handler_profile
+        if profile is not None:
+            profile.enter(self, node, 'text')
+        try:
+            start = len(tokens)
+            pre, post = self.get_pre_post(client, node, replaceEnt)
+            if pre:
+                tokens.extend(tag_tokens(pre))
+            self.add_tokens(client, node, replaceEnt, tokens)
+            if post:
+                tokens.extend(tag_tokens(post))
+
+            smarty = client.smartypants_attributes
+            if type(self).apply_replacements is NodeHandler.apply_replacements:
+                # Same as smartyPants on the joined text, which only
+                # changes the text between tags.
+                if node.__class__ in smarty_nodes:
+                    tokens[start:] = educate_tokens(tokens[start:], smarty)
+            else:
+                text = ''.join(tokens[start:])
+                replaced = self.apply_replacements(text, smarty, node)
+                if replaced != text:
+                    tokens[start:] = markup_tokens(replaced)
+
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(
+                    "%s.tokendispatch: %s",
+                    self.getclassname(self),
+                    ''.join(tokens[start:]),
+                )
+            return tokens
+        finally:
+            if profile is not None:
+                profile.leave()
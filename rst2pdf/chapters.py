@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Lay out the chapters of a document in parallel to find their page numbers.
+
+When a document breaks pages before its top level sections (see
+breaklevel), each chapter starts on a page of its own, so where its
+headings land only depends on the chapter itself and on the page it
+starts on. layout_chapters lays the chapters out separately, one after
+another or in as many processes as it's allowed to, and adds up their
+page counts to work out the page of every heading.
+
+The PDF itself is still built by multiBuild in this process, which
+keeps page numbers, outlines and links right no matter what: the page
+numbers found here only fill in the tables of contents beforehand, so
+the first pass already has them, and if they are wrong multiBuild just
+needs more passes to fix them.
+
+The worker processes are forked, so they get the flowables without
+having to pickle them. Where processes can't be forked, or it's not safe
+to, like on macOS, the chapters are laid out in this process.
+
+A LayoutCache keeps the page counts and heading offsets found for each
+chapter from one build to the next, so the next build only lays out
+again the chapters that changed. That only saves laying them out: the
+PDF is still built in full, with every chapter.
+'''
+
+import hashlib
+from io import BytesIO
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from docutils import nodes
+from reportlab import Version as reportlab_version
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.pdfgen.textobject import PDFTextObject
+
+from . import version
+from .flowables import Heading, MyPageBreak, MyTableOfContents
+from .log import log
+from .manifest import file_digest
+
+# What the forked workers lay out: (elements, make_doctemplate, headings)
+_job = None
+
+
+class _LayoutText(PDFTextObject):
+    """A text object that doesn't turn text into PDF operators, which is
+    where fonts are subset and strings encoded."""
+
+    def _formatText(self, text):
+        return ''
+
+
+class LayoutCanvas(Canvas):
+    """A canvas for laying out flowables and nothing else.
+
+    It is never saved: a chapter on its own links to headings in other
+    chapters, which a saved PDF can't have. Nor does it need outlines,
+    which can't start below the top level. Text and images, which would
+    be encoded and embedded, are not drawn either.
+    """
+
+    def addOutlineEntry(self, *args, **kwargs):
+        pass
+
+    def beginText(self, x=0, y=0, direction=None):
+        return _LayoutText(self, x, y, direction=direction)
+
+    def drawImage(self, image, x, y, width=None, height=None, *args, **kwargs):
+        return width or 0, height or 0
+
+    def drawInlineImage(self, image, x, y, width=None, height=None, *args, **kwargs):
+        return width or 0, height or 0
+
+    def save(self):
+        pass
+
+
+def split_chapters(elements):
+    """Return the (start, end) bounds of the chapters in elements.
+
+    A chapter starts at each page break a section title put in front of
+    itself. Other page breaks may switch templates or backgrounds, which
+    a chapter laid out on its own would not know about, so they don't
+    start chapters. Whatever comes before the first chapter is another.
+    """
+    starts = [0]
+    for i, e in enumerate(elements):
+        if (
+            i
+            and isinstance(e, MyPageBreak)
+            and e.templateName is None
+            and e.background is None
+        ):
+            starts.append(i)
+    return list(zip(starts, starts[1:] + [len(elements)]))
+
+
+def first_page(element, after):
+    """The page a chapter starting with element starts on, if the page
+    before it is page number after."""
+    page = after + 1
+    if isinstance(element, MyPageBreak):
+        if element.breakTo == 'odd' and page % 2 == 0:
+            page += 1
+        elif element.breakTo == 'even' and page % 2:
+            page += 1
+    return page
+
+
+def chapter_headings(elements, start, end):
+    """The indexes of the headings in elements[start:end]."""
+    return [i for i in range(start, end) if isinstance(elements[i], Heading)]
+
+
+def _layout_chapter(bounds):
+    """Lay out elements[start:end] on their own.
+
+    Returns the number of pages, and the page of each heading in the
+    chapter counted from the first page of the chapter.
+    """
+    elements, make_doctemplate, headings = _job
+    start, end = bounds
+    story = elements[start:end]
+    index = {id(elements[i]): i for i in chapter_headings(elements, start, end)}
+    for e in story:
+        if isinstance(e, MyTableOfContents):
+            # Make it as long as it will be
+            e.reserve(headings)
+            e.beforeBuild()
+
+    pdfdoc = make_doctemplate(BytesIO())
+    pages = {}
+
+    def afterFlowable(flowable):
+        i = index.get(id(flowable))
+        if i is not None and i not in pages:
+            pages[i] = pdfdoc.page
+
+    pdfdoc.afterFlowable = afterFlowable
+    first = first_page(story[0], 0)
+    # Laying out changes some flowables, like those kept with the next
+    # one. Undo that, as multiBuild does between passes, in case this is
+    # the process that builds the PDF.
+    edits = []
+    pdfdoc._multiBuildEdits = edits.append
+    try:
+        pdfdoc.build(story, canvasmaker=LayoutCanvas)
+    finally:
+        for edit in edits:
+            edit[0](*edit[1:])
+    count = pdfdoc.page - first + 1
+    return count, [pages[i] - first for i in sorted(pages)]
+
+
+def _init_worker():
+    # The real build logs the same things again
+    if log.getEffectiveLevel() < logging.ERROR:
+        log.setLevel(logging.ERROR)
+
+
+def layout_chapters(elements, make_doctemplate, jobs, cache=None):
+    """Find the page each top level heading in elements lands on.
+
+    make_doctemplate(output) returns the doctemplate to lay the
+    chapters out with, and jobs is how many processes to use, 1 to lay
+    them out in this process. The chapters cache has are not laid out
+    again.
+    Returns {index in elements: page number}, or None if the document
+    has a single chapter or laying it out failed.
+    """
+    chapters = split_chapters(elements)
+    if len(chapters) < 2:
+        return None
+    keys = [None] * len(chapters)
+    layouts = [None] * len(chapters)
+    if cache is not None:
+        for n, (start, end) in enumerate(chapters):
+            keys[n] = cache.key(elements, start, end)
+            layouts[n] = cache.get(keys[n])
+    todo = [bounds for bounds, layout in zip(chapters, layouts) if layout is None]
+
+    # No more processes than chapters to lay out
+    jobs = max(min(jobs, len(todo)), 1)
+    if jobs > 1 and _fork_context() is None:
+        log.info('Cannot fork processes here, laying out chapters in this one')
+        jobs = 1
+    started = time.perf_counter()
+    if todo:
+        results = _layout(elements, make_doctemplate, jobs, todo)
+        if results is None:
+            return None
+        results = iter(results)
+        for n, layout in enumerate(layouts):
+            if layout is None:
+                layouts[n] = next(results)
+                if cache is not None:
+                    cache.put(keys[n], layouts[n])
+    if cache is not None:
+        cache.save()
+
+    pages = {}
+    last = 0
+    for (start, end), (count, offsets) in zip(chapters, layouts):
+        page = first_page(elements[start], last)
+        for i, offset in zip(chapter_headings(elements, start, end), offsets):
+            pages[i] = page + offset
+        last = page + count - 1
+    log.info(
+        'Laid out %d of %d chapters in %d processes in %.2fs, %d pages in all',
+        len(todo),
+        len(chapters),
+        jobs,
+        time.perf_counter() - started,
+        last,
+    )
+    return pages
+
+
+def _fork_context():
+    """The multiprocessing context that forks processes, or None where
+    they can't be forked safely."""
+    # Forked processes may crash in the system libraries of macOS
+    if sys.platform == 'darwin':
+        return None
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
+def _layout(elements, make_doctemplate, jobs, chapters):
+    """Lay out chapters in jobs processes, or in this one if jobs is 1,
+    see _layout_chapter."""
+    global _job
+    headings = [e for e in elements if isinstance(e, Heading)]
+    _job = elements, make_doctemplate, headings
+    level = log.level
+    try:
+        if jobs == 1:
+            _init_worker()
+            return [_layout_chapter(bounds) for bounds in chapters]
+        with _fork_context().Pool(jobs, initializer=_init_worker) as pool:
+            chunksize = max(1, len(chapters) // (jobs * 4))
+            return pool.map(_layout_chapter, chapters, chunksize)
+    except Exception as e:
+        # The build works without the page numbers, it just takes longer
+        log.warning('Laying out chapters failed, building without it: %s', e)
+        return None
+    finally:
+        _job = None
+        log.setLevel(level)
+
+
+# Attributes of a node that tell it apart from the rest of the document,
+# and not what it looks like
+_ID_ATTRIBUTES = {'ids', 'names', 'dupnames', 'backrefs', 'refid'}
+
+# The options of RstToPdf the layout depends on
+_LAYOUT_OPTIONS = (
+    'background_fit_mode',
+    'basedir',
+    'baseurl',
+    'blank_first_page',
+    'breaklevel',
+    'breakside',
+    'custom_cover',
+    'def_dpi',
+    'first_page_on_right',
+    'fit_mode',
+    'floating_images',
+    'font_path',
+    'footer',
+    'footnote_backlinks',
+    'header',
+    'highlightlang',
+    'inline_footnotes',
+    'inline_fragments',
+    'inlinelinks',
+    'language',
+    'numbered_links',
+    'raw_html',
+    'real_footnotes',
+    'repeat_table_rows',
+    'section_header_depth',
+    'show_frame',
+    'smartypants_attributes',
+    'sphinx',
+    'splittables',
+    'strip_elements_with_classes',
+    'style_path',
+    'toc_depth',
+)
+
+
+def file_stamp(path):
+    """The modification time and size of path, to tell cheaply when it
+    is written to."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def fingerprint(client):
+    """A digest of what the layout of every chapter depends on.
+
+    That is the versions of rst2pdf and reportlab, the options of
+    client in _LAYOUT_OPTIONS, its page size and the files recorded in
+    its record_dependencies, like stylesheets and fonts. Files are told
+    apart by their contents, so touching one or checking it out again
+    doesn't throw the cache away.
+    """
+    options = [(name, getattr(client, name, None)) for name in _LAYOUT_OPTIONS]
+    digest = hashlib.sha1(
+        repr((version, reportlab_version, options, client.styles.ps)).encode()
+    )
+    if client.record_dependencies is not None:
+        for path in client.record_dependencies.list:
+            digest.update(repr((path, file_digest(path))).encode())
+    return digest.hexdigest()
+
+
+class LayoutCache(object):
+    """The page counts and heading offsets of chapters from earlier
+    builds, kept in a JSON file.
+
+    A chapter is looked up by a digest of its flowables and of the
+    section of the doctree it starts with, so only the chapters that
+    changed are laid out again. When the fingerprint changes (see
+    fingerprint()) the whole cache is thrown away.
+    """
+
+    def __init__(self, path, fingerprint, basedir='.', doctree=None, cover=''):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.basedir = basedir
+        # What the first chapter is made of, besides its section
+        self.doctree = doctree
+        self.cover = cover
+        self.chapters = {}
+        self.used = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if isinstance(data, dict) and data.get('fingerprint') == fingerprint:
+            self.chapters = data.get('chapters', {})
+
+    def key(self, elements, start, end):
+        """The key of the chapter in elements[start:end], or None if it
+        can't be cached.
+
+        A chapter is told apart by the section of the doctree it starts
+        with. The first chapter also has the cover and whatever comes
+        before the first section, and one with a table of contents
+        depends on every heading in the document. Other chapters without
+        a section can't be told apart from any other.
+        """
+        story = elements[start:end]
+        digest = hashlib.sha1()
+        digest.update(' '.join(type(e).__name__ for e in story).encode())
+        roots = []
+        if start == 0:
+            if self.doctree is None:
+                return None
+            digest.update(self.cover.encode())
+            for node in self.doctree.children:
+                if isinstance(node, nodes.section):
+                    break
+                roots.append(node)
+        for e in story:
+            if (
+                isinstance(e, Heading)
+                and e.node is not None
+                and isinstance(e.node.parent, nodes.section)
+            ):
+                roots.append(e.node.parent)
+                break
+        else:
+            if start:
+                return None
+        if any(isinstance(e, MyTableOfContents) for e in story):
+            headings = [(e.level, e.text) for e in elements if isinstance(e, Heading)]
+            digest.update(repr(headings).encode())
+        for root in roots:
+            self._digest_nodes(digest, root)
+        return digest.hexdigest()
+
+    def _digest_nodes(self, digest, root):
+        """Add root and the nodes in it to digest, leaving out what only
+        tells them apart from the rest of the document."""
+        for node in root.findall():
+            if isinstance(node, nodes.Text):
+                digest.update(repr(node.astext()).encode())
+                continue
+            attributes = sorted(
+                (name, value)
+                for name, value in node.attributes.items()
+                if name not in _ID_ATTRIBUTES
+            )
+            digest.update(repr((node.tagname, len(node.children), attributes)).encode())
+            if isinstance(node, nodes.image):
+                uri = os.path.join(self.basedir, node['uri'])
+                digest.update(repr(file_digest(uri)).encode())
+
+    def get(self, key):
+        """Return (page count, heading offsets) for key, or None."""
+        if key not in self.chapters:
+            return None
+        self.used[key] = self.chapters[key]
+        return self.chapters[key]
+
+    def put(self, key, layout):
+        if key is not None:
+            # As it comes back from JSON
+            count, offsets = layout
+            self.used[key] = [count, list(offsets)]
+
+    def save(self):
+        """Write the chapters of this build to the cache file, leaving
+        out the ones that are gone."""
+        if self.used == self.chapters:
+            return
+        self.chapters = self.used
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(
+                    {'fingerprint': self.fingerprint, 'chapters': self.chapters}, f
+                )
+        except OSError as e:
+            log.warning('Cannot write the layout cache to %s: %s', self.path, e)
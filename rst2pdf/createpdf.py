@@ -36,8 +36,10 @@
 
 __docformat__ = 'reStructuredText'
 
+from contextlib import nullcontext
 from importlib import import_module
 
+import json
 import sys
 import os
 import re
@@ -81,10 +83,13 @@ from reportlab.platypus.flowables import (
     PageBreak,
     SlowPageBreak,
 )
+from reportlab.pdfbase.pdfdoc import PDFObjectReference
+from reportlab.pdfgen.canvas import Canvas
 from reportlab.platypus.paragraph import Paragraph
 from reportlab.platypus.tables import TableStyle
 
 from . import config
+from .orderedset import OrderedSet
 from .utils import DependencyRecordingFileSystemLoader
 
 from rst2pdf.directives import code_block
@@ -92,15 +97,27 @@ from rst2pdf import flowables
 from rst2pdf.flowables import (
     BoundByWidth,
     DelayedTable,
+    ListItem,
     Heading,
     MyPageBreak,
     MySpacer,
+    MyTableOfContents,
     OddEven,
     Separation,
     SmartFrame,
+    WrapCache,
     XXPreformatted,
 )
+from rst2pdf.chapters import LayoutCache, LayoutCanvas, fingerprint, layout_chapters
+from rst2pdf.doctreecache import DoctreeCache
+from rst2pdf.dryrun import dry_run_layout
+from rst2pdf.flowablecache import FlowableCache
+from rst2pdf.handlerprofile import HandlerProfile
+from rst2pdf.manifest import options_digest, up_to_date, write_manifest
+from rst2pdf.watch import watch
+from rst2pdf.phases import PhaseProfile, phase, recorded, timed
 from rst2pdf.sinker import Sinker
+from rst2pdf.streaming import Story, peak_memory, split_sections, why_not_stream
 from rst2pdf.image import MyImage, missing
 from rst2pdf.log import log, nodeid
 from rst2pdf import styles as sty
@@ -168,6 +185,18 @@ class RstToPdf(object):
         raw_html=False,
         strip_elements_with_classes=[],
         record_dependencies=None,
+        inline_fragments=False,
+        paragraph_cache_size=0,
+        reserve_toc=False,
+        layout_jobs=1,
+        layout_cache=None,
+        doctree_cache=None,
+        flowable_cache=None,
+        dry_run_layout=False,
+        max_pages=0,
+        stream=False,
+        profile_phases=False,
+        profile_handlers=False,
     ):
         self.debugLinesPdf = False
         self.depth = 0
@@ -200,10 +229,20 @@ class RstToPdf(object):
         self.font_path = font_path
         self.style_path = style_path
         self.def_dpi = def_dpi
+        if layout_cache and not reserve_toc:
+            log.warning('--layout-cache needs --reserve-toc, ignoring it')
+            layout_cache = None
         if record_dependencies is not None:
             self.record_dependencies = DependencyList(record_dependencies)
+        elif layout_cache or flowable_cache:
+            # The caches are only good as long as these don't change
+            self.record_dependencies = DependencyList()
         else:
             self.record_dependencies = None
+        # Where the time and memory of each phase of the builds go
+        self.phase_profile = PhaseProfile() if profile_phases else None
+        # Where the time making the flowables goes, handler by handler
+        self.handler_profile = HandlerProfile() if profile_handlers else None
         self.loadStyles(stylesheets)
 
         self.docutils_languages = {}
@@ -231,6 +270,25 @@ class RstToPdf(object):
         self.img_dir = os.path.join(self.PATH, 'images')
         self.raw_html = raw_html
         self.strip_elements_with_classes = strip_elements_with_classes
+        self.inline_fragments = inline_fragments
+        self.paragraph_cache_size = paragraph_cache_size
+        # Line breaks shared by identical paragraphs, see CachedParagraph
+        self.paragraph_cache = (
+            WrapCache(paragraph_cache_size) if paragraph_cache_size else None
+        )
+        # How many times tables were wrapped, and how many of those reused
+        # a Table built before, see DelayedTable
+        self.table_wrap_stats = {'hits': 0, 'misses': 0}
+        self.reserve_toc = reserve_toc
+        self.layout_jobs = layout_jobs
+        self.layout_cache = layout_cache
+        self.doctree_cache = doctree_cache and DoctreeCache(doctree_cache)
+        # What the cached doctree is kept by, if any
+        self.doctree_key = None
+        self.flowable_cache = flowable_cache and FlowableCache(flowable_cache)
+        self.dry_run_layout = dry_run_layout
+        self.max_pages = max_pages
+        self.stream = stream
 
         # Sorry about this, but importing sphinx.roles makes some
         # ordinary documents fail (demo.txt specifically) so
@@ -241,12 +299,20 @@ class RstToPdf(object):
             from rst2pdf.sphinxnodes import sphinxhandlers
 
             self.highlightlang = highlightlang
-            self.gen_pdftext, self.gen_elements = sphinxhandlers(self)
+            (
+                self.gen_pdftext,
+                self.gen_elements,
+                self.gen_pdftokens,
+            ) = sphinxhandlers(self)
         else:
             # These rst2pdf extensions conflict with sphinx
             directives.register_directive('code-block', code_block.code_block_directive)
             directives.register_directive('code', code_block.code_block_directive)
-            self.gen_pdftext, self.gen_elements = nodehandlers(self)
+            (
+                self.gen_pdftext,
+                self.gen_elements,
+                self.gen_pdftokens,
+            ) = nodehandlers(self)
 
         self.sphinx = sphinx
 
@@ -262,9 +328,10 @@ class RstToPdf(object):
         for lang in self.styles.languages:
             self.docutils_languages[lang] = get_language_available(lang)[2]
 
-        self.pending_targets = []
-        self.targets = []
+        self.pending_targets = OrderedSet()
+        self.targets = OrderedSet()
 
+    @recorded('stylesheets')
     def loadStyles(self, styleSheets=None):
 
         if styleSheets is None:
@@ -369,7 +436,13 @@ class RstToPdf(object):
             return None
 
     def gather_pdftext(self, node, replaceEnt=True):
-        return ''.join([self.gen_pdftext(n, replaceEnt) for n in node.children])
+        return ''.join(self.gather_pdftokens(node, replaceEnt))
+
+    def gather_pdftokens(self, node, replaceEnt=True):
+        tokens = []
+        for n in node.children:
+            self.gen_pdftokens(n, replaceEnt, tokens)
+        return tokens
 
     def gather_elements(self, node, style=None):
         if style is None:
@@ -440,54 +513,59 @@ class RstToPdf(object):
         * Once the table is *normalized*, create spans list, fitting for reportlab's
         Table class.
 
-        """
+        The rows are normalized in place, in a single pass over the cells:
+        ``covered[x]`` holds how many more rows column ``x`` is occupied by
+        a multirow cell from a previous row, so each cell is placed at the
+        first free column without shifting the rest of its row around.
 
-        # If there is a multicol cell, we need to insert Continuation Cells
-        # to make all rows the same length
+        """
 
-        for y in range(0, len(rows)):
-            for x in range(len(rows[y]) - 1, -1, -1):
-                cell = rows[y][x]
+        covered = []
+        spans = []
+        for y, row in enumerate(rows):
+            newrow = []
+            x = 0
+            for cell in row:
+                # Skip the columns still occupied by multirow cells from above
+                while x < len(covered) and covered[x]:
+                    covered[x] -= 1
+                    newrow.append("")
+                    x += 1
+                newrow.append(cell)
                 if isinstance(cell, str):
-                    continue
-                if cell.get("morecols"):
-                    for i in range(0, cell.get("morecols")):
+                    mc = mr = 0
+                else:
+                    mc = cell.get("morecols") or 0
+                    mr = cell.get("morerows") or 0
+                if mc or mr:
+                    spans.append(('SPAN', (x, y), (x + mc, y + mr)))
+                    # If there is a multicol cell, we need to insert
+                    # Continuation Cells to make all rows the same length.
+                    # These cells have to be multirow if the original cell
+                    # is multirow.
+                    for i in range(x + 1, x + mc + 1):
                         e = docutils.nodes.entry("")
                         e["morerows"] = cell.get("morerows", 0)
-                        rows[y].insert(x + 1, e)
-
-        for y in range(0, len(rows)):
-            for x in range(0, len(rows[y])):
-                cell = rows[y][x]
-                if isinstance(cell, str):
-                    continue
-                if cell.get("morerows"):
-                    for i in range(0, cell.get("morerows")):
-                        rows[y + i + 1].insert(x, "")
+                        newrow.append(e)
+                        if mr:
+                            spans.append(('SPAN', (i, y), (i, y + mr)))
+                if len(covered) <= x + mc:
+                    covered.extend([0] * (x + mc + 1 - len(covered)))
+                for x in range(x, x + mc + 1):
+                    covered[x] = mr
+                x += 1
+            # Columns past the last cell may still be occupied from above
+            for x in range(x, len(covered)):
+                if covered[x]:
+                    covered[x] -= 1
+                newrow.append("")
+            row[:] = newrow
 
         # If a row is shorter, add empty cells at the right end
         maxw = max([len(r) for r in rows])
         for r in rows:
-            while len(r) < maxw:
-                r.append("")
+            r.extend([""] * (maxw - len(r)))
 
-        # Create spans list for reportlab's table style
-        spans = []
-        for y in range(0, len(rows)):
-            for x in range(0, len(rows[y])):
-                cell = rows[y][x]
-                if isinstance(cell, str):
-                    continue
-                if cell.get("morecols"):
-                    mc = cell.get("morecols")
-                else:
-                    mc = 0
-                if cell.get("morerows"):
-                    mr = cell.get("morerows")
-                else:
-                    mr = 0
-                if mc or mr:
-                    spans.append(('SPAN', (x, y), (x + mc, y + mr)))
         return spans
 
     def PreformattedFit(self, text, style):
@@ -501,6 +579,134 @@ class RstToPdf(object):
             style=style,
         )
 
+    def parse(self, text, source_path, settings_overrides):
+        """Parse text into a doctree, unless doctree_cache has it."""
+        if self.doctree_cache is None:
+            return docutils.core.publish_doctree(
+                text, source_path=source_path, settings_overrides=settings_overrides
+            )
+        # Includes are found relative to the source, or the current directory
+        self.doctree_key = self.doctree_cache.key(
+            text, os.path.abspath(source_path or ''), sorted(settings_overrides.items())
+        )
+        return self.cached_doctree(
+            self.doctree_key,
+            lambda: docutils.core.publish_doctree(
+                text, source_path=source_path, settings_overrides=settings_overrides
+            ),
+        )
+
+    @timed('decoration parse')
+    def secondary_doctree(self, text, source_path):
+        """Parse text into a doctree that uses the substitutions of the
+        document, like the cover and the default header and footer,
+        unless doctree_cache has it."""
+        if self.doctree_key is None:
+            return publish_secondary_doctree(text, self.doctree, source_path)
+        substitutions = sorted(
+            (name, node.pformat())
+            for name, node in self.doctree.substitution_defs.items()
+        )
+        return self.cached_doctree(
+            self.doctree_cache.key(self.doctree_key, substitutions, text, source_path),
+            lambda: publish_secondary_doctree(text, self.doctree, source_path),
+        )
+
+    def cached_doctree(self, key, publish):
+        doctree = self.doctree_cache.get(key)
+        if doctree is None:
+            doctree = publish()
+            self.doctree_cache.put(key, doctree)
+        else:
+            log.info('Using cached doctree %s', key)
+        return doctree
+
+    def reserve_toc_entries(self, elements, pages=None):
+        """Give the tables of contents in elements an entry for each
+        heading, so the first pass makes room for all of them.
+
+        pages is the page number of each heading by its index in
+        elements, if known (see layout_chapters).
+        Returns a list of (toc, entries) for check_toc_entries.
+        """
+        tocs = [e for e in elements if isinstance(e, MyTableOfContents)]
+        if not tocs:
+            return []
+        headings = [(i, e) for i, e in enumerate(elements) if isinstance(e, Heading)]
+        numbers = None
+        if pages is not None:
+            numbers = [str(pages[i]) if i in pages else 0 for i, e in headings]
+        headings = [e for i, e in headings]
+        reserved = [(toc, toc.reserve(headings, numbers)) for toc in tocs]
+        log.info(
+            'Reserved room for %d TOC entries',
+            sum(len(entries) for toc, entries in reserved),
+        )
+        return reserved
+
+    def check_toc_entries(self, reserved, passes):
+        """Log whether reserving room for the tables of contents worked,
+        and how many passes it saved.
+
+        Without it, the first pass only has a placeholder for each TOC,
+        so the second one moves everything after them and it takes one
+        more pass for the page numbers to settle. When the page numbers
+        were reserved too, the first pass can be the only one. Either
+        way, right entries save the pass that an unreserved build spends
+        finding them, and wrong ones save none.
+        """
+        for toc, entries in reserved:
+            n = len(entries[0]) if entries else 0
+            if [entry[:n] for entry in toc._entries] != entries:
+                log.info(
+                    'The reserved TOC entries were wrong, '
+                    'the build took %d passes, none saved',
+                    passes,
+                )
+                return
+        log.info(
+            'The reserved TOC entries were right, '
+            'the build took %d passes instead of %d, one saved',
+            passes,
+            passes + 1,
+        )
+
+    def endnote_elements(self):
+        """The flowables of the endnotes gathered so far."""
+        endnotes = self.decoration['endnotes']
+        if not endnotes:
+            return []
+        elements = [MySpacer(1, 2 * cm), Separation()]
+        for n in endnotes:
+            t_style = TableStyle(self.styles['endnote'].commands)
+            colWidths = self.styles['endnote'].colWidths
+            elements.append(
+                DelayedTable(
+                    [[n[0], n[1]]], colWidths=colWidths, style=t_style, client=self
+                )
+            )
+        return elements
+
+    def stream_elements(self, sections):
+        """Generate the flowables of sections, taken out of the doctree
+        by split_sections, and then the endnotes, letting go of each
+        section once it's done."""
+        style = self.styles.styleForNode(self.doctree)
+        sections.reverse()
+        while sections:
+            section = sections.pop()
+            with phase('elements'):
+                elements = self.gen_elements(section, style=style)
+            # Something else may still point at the section, like the
+            # state machines docutils keeps for its next parse, so it
+            # lets go of its nodes and of the flowables made out of them
+            del section[:]
+            section.elements = None
+            del section
+            yield from elements
+        yield from self.endnote_elements()
+
+    @recorded('other')
     def createPdf(
         self,
         text=None,
@@ -527,11 +733,14 @@ class RstToPdf(object):
             'extraflowables': [],
         }
 
-        self.pending_targets = []
-        self.targets = []
+        self.pending_targets = OrderedSet()
+        self.targets = OrderedSet()
 
         self.debugLinesPdf = debugLinesPdf
 
+        if self.flowable_cache is not None:
+            self.flowable_cache.hits = self.flowable_cache.misses = 0
+
         if doctree is None:
             if text is not None:
                 if self.language:
@@ -544,11 +753,8 @@ class RstToPdf(object):
                 settings_overrides['exit_status_level'] = 3
 
                 try:
-                    self.doctree = docutils.core.publish_doctree(
-                        text,
-                        source_path=source_path,
-                        settings_overrides=settings_overrides,
-                    )
+                    with phase('parse'):
+                        self.doctree = self.parse(text, source_path, settings_overrides)
                     log.debug(self.doctree)
                 except Exception as e:
                     if log.isEnabledFor(logging.INFO):
@@ -563,10 +769,14 @@ class RstToPdf(object):
                 return 1
         else:
             self.doctree = doctree
+            self.doctree_key = None
 
         if self.record_dependencies is not None:
-            for dep in self.doctree.settings.record_dependencies.list:
-                self.record_dependencies.add(dep)
+            # Sphinx doesn't record them
+            dependencies = self.doctree.settings.record_dependencies
+            if dependencies is not None:
+                for dep in dependencies.list:
+                    self.record_dependencies.add(dep)
 
         if self.numbered_links:
             # Transform all links to sections so they show numbers
@@ -587,8 +797,27 @@ class RstToPdf(object):
             # use the `:depth:` option from `.. contents::`
             self.toc_depth = contents.Contents.depth
 
+        layout_fingerprint = None
+        if self.layout_cache:
+            # Before the images the chapters use are recorded, their own
+            # keys take care of those
+            layout_fingerprint = fingerprint(self)
+        # The top level sections, when they are made into flowables as
+        # the build gets to them
+        sections = []
+        if self.stream:
+            reason = why_not_stream(self, self.doctree)
+            if reason is None and doctree is not None:
+                # Streaming takes the doctree apart, and this one is the
+                # caller's
+                reason = 'it was given a doctree instead of text'
+            if reason is None:
+                sections = split_sections(self.doctree)
+            else:
+                log.info('Cannot stream the build, %s', reason)
         try:
-            elements = self.gen_elements(self.doctree)
+            with phase('elements'):
+                elements = self.gen_elements(self.doctree)
         except Exception as e:
             if log.isEnabledFor(logging.INFO):
                 # Log exception with traceback if more detailed logging has been set
@@ -597,6 +826,12 @@ class RstToPdf(object):
                 log.error(f"Error generating document elements: {e}")
             log.error("Cannot generate PDF, exiting")
             return 1
+        if self.flowable_cache is not None:
+            log.info(
+                'Took the flowables of %d of %d sections from the cache',
+                self.flowable_cache.hits,
+                self.flowable_cache.hits + self.flowable_cache.misses,
+            )
 
         # Find cover template, save it in cover_file
         jinja_env = jinja2.Environment(
@@ -623,27 +858,27 @@ class RstToPdf(object):
         # This crashes sphinx because .. class:: in sphinx is
         # something else. Ergo, pdfbuilder does it in its own way.
         if not self.sphinx:
-            elements = (
-                self.gen_elements(
-                    publish_secondary_doctree(cover_text, self.doctree, source_path)
+            if sections:
+                # The targets pending before the first section are its
+                # own, not the cover's
+                pending, self.pending_targets = self.pending_targets, OrderedSet()
+            with phase('elements'):
+                cover = self.gen_elements(
+                    self.secondary_doctree(cover_text, source_path)
                 )
-                + elements
-            )
+            if sections:
+                self.pending_targets = pending
+            elements = cover + elements
 
         if self.blank_first_page:
             elements.insert(0, PageBreak())
 
-        # Put the endnotes at the end ;-)
-        endnotes = self.decoration['endnotes']
-        if endnotes:
-            elements.append(MySpacer(1, 2 * cm))
-            elements.append(Separation())
-            for n in self.decoration['endnotes']:
-                t_style = TableStyle(self.styles['endnote'].commands)
-                colWidths = self.styles['endnote'].colWidths
-                elements.append(
-                    DelayedTable([[n[0], n[1]]], colWidths=colWidths, style=t_style)
-                )
+        if sections:
+            # The endnotes come after the sections, which aren't there yet
+            elements = Story(elements, self.stream_elements(sections))
+        else:
+            # Put the endnotes at the end ;-)
+            elements.extend(self.endnote_elements())
 
         if self.floating_images:
             # Handle images with alignment more like in HTML
@@ -665,37 +900,97 @@ class RstToPdf(object):
         head = self.decoration['header']
         foot = self.decoration['footer']
 
-        # So, now, create the FancyPage with the right sizes and elements
-        FP = FancyPage("fancypage", head, foot, self)
-
         def cleantags(s):
             re.sub(r'<[^>]*?>', '', str(s).strip())
 
-        pdfdoc = FancyDocTemplate(
-            output,
-            pageTemplates=[FP],
-            showBoundary=0,
-            pagesize=self.styles.ps,
-            title=self.doc_title_clean,
-            author=self.doc_author,
-            pageCompression=compressed,
-        )
-        pdfdoc.client = self
+        def make_doctemplate(output):
+            # So, now, create the FancyPage with the right sizes and elements
+            FP = FancyPage("fancypage", head, foot, self)
+            pdfdoc = FancyDocTemplate(
+                output,
+                pageTemplates=[FP],
+                showBoundary=0,
+                pagesize=self.styles.ps,
+                title=self.doc_title_clean,
+                author=self.doc_author,
+                pageCompression=compressed,
+            )
+            pdfdoc.client = self
+            return pdfdoc
+
+        pdfdoc = make_doctemplate(output)
 
         # Handle totally empty documents (Issue #547)
         if not elements:
             elements.append(Paragraph("", style=self.styles['base']))
-        if getattr(self, 'mustMultiBuild', False):
+        if getattr(self, 'mustMultiBuild', False) and not self.max_pages:
             # Force a multibuild pass
             if not isinstance(elements[-1], UnhappyOnce):
                 log.info('Forcing second pass so Total pages work')
                 elements.append(UnhappyOnce())
+        self.table_wrap_stats.update(hits=0, misses=0)
+        if self.paragraph_cache is not None:
+            self.paragraph_cache.clear()
+        reserved = None
+        if (
+            self.reserve_toc
+            and not self.max_pages
+            and any(isinstance(e, MyTableOfContents) for e in elements)
+        ):
+            cache = None
+            if self.layout_cache:
+                cache = LayoutCache(
+                    self.layout_cache,
+                    layout_fingerprint,
+                    self.basedir,
+                    self.doctree,
+                    cover_text,
+                )
+            with phase('chapters'):
+                pages = layout_chapters(
+                    elements, make_doctemplate, self.layout_jobs, cache
+                )
+            if pages:
+                reserved = self.reserve_toc_entries(elements, pages)
+        if reserved is None and self.reserve_toc:
+            reserved = self.reserve_toc_entries(elements)
+        build_options = {}
+        if self.dry_run_layout:
+            # Lay the document out as usual, but don't draw nor save it
+            build_options['canvasmaker'] = LayoutCanvas
+            headings = {}
+            notify = pdfdoc.afterFlowable
+
+            def afterFlowable(flowable):
+                notify(flowable)
+                if isinstance(flowable, Heading):
+                    headings[id(flowable)] = (
+                        flowable.level,
+                        flowable.getPlainText(),
+                        pdfdoc.page,
+                    )
+
+            pdfdoc.afterFlowable = afterFlowable
+        elif self.max_pages:
+            build_options['canvasmaker'] = PreviewCanvas
+        pdfdoc.max_pages = self.max_pages
+        pdfdoc.profiled = self.phase_profile is not None
         while True:
             try:
                 log.info("Starting build")
                 self.elements = elements
                 # See if this *must* be multipass
-                pdfdoc.multiBuild(elements)
+                if self.max_pages or sections:
+                    # A preview of the first pages, or a streamed build,
+                    # in a single pass. build uses up the list it's given,
+                    # and only a streamed build is meant to.
+                    pdfdoc.build(elements if sections else elements[:], **build_options)
+                    passes = 1
+                else:
+                    passes = pdfdoc.multiBuild(elements, **build_options)
+                if reserved:
+                    self.check_toc_entries(reserved, passes)
+                    reserved = None
                 # Force a multibuild pass
 
                 # FIXME: since mustMultiBuild is set by the
@@ -703,14 +998,15 @@ class RstToPdf(object):
                 # make a new forced two-pass build. This is broken.
                 # conceptually.
 
-                if getattr(self, 'mustMultiBuild', False):
+                if getattr(self, 'mustMultiBuild', False) and not self.max_pages:
                     # Force a multibuild pass
                     if not isinstance(elements[-1], UnhappyOnce):
                         log.info('Forcing second pass so Total pages work')
                         elements.append(UnhappyOnce())
                         continue
-                # Rearrange footnotes if needed
-                if self.real_footnotes:
+                # Rearrange footnotes if needed, but not in a preview,
+                # which is only laid out once
+                if self.real_footnotes and not self.max_pages:
                     newStory = []
                     fnPile = []
                     for e in elements:
@@ -749,9 +1045,41 @@ class RstToPdf(object):
                 # else:
                 # raise
                 raise
+        peak = peak_memory()
+        if peak is not None:
+            log.info('Peak memory use: %.0f MB', peak)
+        if self.dry_run_layout:
+            self.layout_summary = {
+                'pages': pdfdoc.page,
+                'passes': passes,
+                'headings': [
+                    {'level': level, 'text': text, 'page': page}
+                    for level, text, page in headings.values()
+                ],
+            }
 
         # doc = SimpleDocTemplate("phello.pdf")
         # doc.build(elements)
+        hits = self.table_wrap_stats['hits']
+        wraps = hits + self.table_wrap_stats['misses']
+        if wraps:
+            log.debug(
+                'Tables wrapped %d times, %d (%.0f%%) reusing a built table',
+                wraps,
+                hits,
+                100.0 * hits / wraps,
+            )
+        if self.paragraph_cache is not None:
+            hits = self.paragraph_cache.hits
+            wraps = hits + self.paragraph_cache.misses
+            if wraps:
+                log.info(
+                    'Paragraphs wrapped %d times, %d (%.0f%%) served from the cache',
+                    wraps,
+                    hits,
+                    100.0 * hits / wraps,
+                )
+            self.paragraph_cache.clear()
         for fn in self.to_unlink:
             try:
                 os.unlink(fn)
@@ -761,7 +1089,30 @@ class RstToPdf(object):
         return 0
 
 
+class _EnoughPages(Exception):
+    pass
+
+
+class PreviewCanvas(Canvas):
+    """A canvas for the first pages of a document, where links may
+    point at pages that were not laid out: they go to the last page."""
+
+    def save(self):
+        last = PDFObjectReference('Page%d' % (self._doc.pageCounter - 1))
+        for destination in self._destinations.values():
+            if destination.fmt is None:
+                destination.fit()
+                destination.setPage(last)
+        Canvas.save(self)
+
+
 class FancyDocTemplate(BaseDocTemplate):
+    # Stop laying out after this many pages, if not 0
+    max_pages = 0
+    # Record each pass of the build, and saving the PDF, as phases
+    profiled = False
+    passes = 0
+
     def onProgress(self, typ, value):
         global _counter
         message = ''
@@ -779,6 +1130,29 @@ class FancyDocTemplate(BaseDocTemplate):
     def afterInit(self):
         self.setProgressCallBack(self.onProgress)
 
+    def build(self, flowables, filename=None, canvasmaker=Canvas):
+        self.passes += 1
+        with phase('pass %d' % self.passes) if self.profiled else nullcontext():
+            try:
+                BaseDocTemplate.build(self, flowables, filename, canvasmaker)
+            except _EnoughPages:
+                # The rest of the flowables are dropped without laying them
+                # out, and the document ends like BaseDocTemplate.build does
+                self.canv._doc.info = self._savedInfo
+                self._endBuild()
+
+    def _makeCanvas(self, filename=None, canvasmaker=Canvas):
+        canv = BaseDocTemplate._makeCanvas(self, filename, canvasmaker)
+        if self.profiled:
+            canv.save = timed('serialization')(canv.save)
+        return canv
+
+    def handle_pageEnd(self):
+        BaseDocTemplate.handle_pageEnd(self)
+        if self.max_pages and self.page >= self.max_pages:
+            log.info('Stopping after %d pages', self.page)
+            raise _EnoughPages()
+
     def afterFlowable(self, flowable):
 
         if isinstance(flowable, Heading):
@@ -953,6 +1327,16 @@ class HeaderOrFooter(object):
         self.loc, self.showloc, self.defaultloc, self.addsep = locinfo.split()
         self.totalpages = 0
         self.client = client
+        # The doctrees of the templates' default texts, by text
+        self.doctrees = {}
+
+    def default_doctree(self, text):
+        """The doctree for a template's default header or footer,
+        parsed once instead of on every page."""
+        doctree = self.doctrees.get(text)
+        if doctree is None:
+            doctree = self.doctrees[text] = self.client.secondary_doctree(text, None)
+        return doctree
 
     def prepare(self, pageobj, canv, doc):
         showloc = pageobj.template.get(self.showloc, True)
@@ -962,9 +1346,7 @@ class HeaderOrFooter(object):
             if not items:
                 items = pageobj.template.get(self.defaultloc)
                 if items:
-                    items = self.client.gen_elements(
-                        publish_secondary_doctree(items, self.client.doctree, None)
-                    )
+                    items = self.client.gen_elements(self.default_doctree(items))
             if items:
                 if isinstance(items, list):
                     items = items[:]
@@ -1017,7 +1399,15 @@ class HeaderOrFooter(object):
                             data[r][c] = self.replaceTokens(cell, canv, doc, smarty)
                         else:
                             row[c] = self.replaceTokens([cell], canv, doc, smarty)[0]
-                elems[i] = DelayedTable(data, e._colWidths, e.style)
+                elems[i] = DelayedTable(data, e._colWidths, e.style, client=self)
+            elif isinstance(e, ListItem):
+                elems[i] = ListItem(
+                    self.replaceTokens([e.bullet], canv, doc, smarty)[0],
+                    self.replaceTokens(deepcopy(e.content), canv, doc, smarty),
+                    e._colWidths,
+                    e.style,
+                    e.splittable,
+                )
             elif isinstance(e, BoundByWidth):
                 for index, item in enumerate(e.content):
                     if isinstance(item, Paragraph):
@@ -1053,6 +1443,7 @@ class FancyPage(PageTemplate):
         self.smartypants_attributes = client.smartypants_attributes
         self.show_frame = client.show_frame
         self.image_cache = {}
+        self.frame_layouts = {}
         PageTemplate.__init__(self, _id, [])
 
     def draw_background(self, which, canv):
@@ -1061,6 +1452,8 @@ class FancyPage(PageTemplate):
 
         Calculates the image one time, and caches
         it for reuse on every page in the template.
+        It is drawn once per PDF into a form, which
+        each page then refers to.
 
         How the background is drawn depends on the
         --fit-background-mode option.
@@ -1074,7 +1467,9 @@ class FancyPage(PageTemplate):
         if 'background_fit_mode' in self.template:
             background_fit_mode = self.template['background_fit_mode']
 
-        info = self.image_cache.get(f"{uri}{background_fit_mode}")
+        pw, ph = self.styles.pw, self.styles.ph
+        key = (uri, background_fit_mode, pw, ph)
+        info = self.image_cache.get(key)
         if info is None:
             fname, _, _ = MyImage.split_uri(uri)
             if not os.path.exists(fname):
@@ -1096,7 +1491,6 @@ class FancyPage(PageTemplate):
                     100,
                 )
 
-            pw, ph = self.styles.pw, self.styles.ph
             if background_fit_mode == 'center':
                 scale = min(1.0, 1.0 * pw / w, 1.0 * ph / h)
                 sw, sh = w * scale, h * scale
@@ -1114,9 +1508,40 @@ class FancyPage(PageTemplate):
                 sw, sh = pw, ph
 
             bg = MyImage(uri, sw, sh, client=self.client)
-            self.image_cache[uri] = info = bg, x, y
-        bg, x, y = info
-        bg.drawOn(canv, x, y)
+            name = 'rst2pdf-%s-%d' % (which, len(self.image_cache))
+            self.image_cache[key] = info = name, bg, x, y
+        name, bg, x, y = info
+        # Every pass of the build has a new canvas
+        if not canv.hasForm(name):
+            canv.beginForm(name)
+            bg.drawOn(canv, x, y)
+            canv.endForm()
+        canv.doForm(name)
+
+    def layout_frames(self, x1, y1):
+        """Work out the position, size and padding of the template's
+        frames, in points, for a text area starting at x1, y1."""
+        styles = self.styles
+        layout = []
+        for frame in self.template['frames']:
+            frame = frame[:]
+            while len(frame) < 8:
+                # This is the default in SmartFrame. At some point in the future we
+                # may want to change this to 0.
+                frame.append(6)
+            layout.append(
+                (
+                    styles.adjustUnits(frame[0], self.tw) + x1,
+                    styles.adjustUnits(frame[1], self.th) + y1,
+                    styles.adjustUnits(frame[2], self.tw),
+                    styles.adjustUnits(frame[3], self.th),
+                    styles.adjustUnits(frame[4], self.tw),
+                    styles.adjustUnits(frame[5], self.th),
+                    styles.adjustUnits(frame[6], self.tw),
+                    styles.adjustUnits(frame[7], self.th),
+                )
+            )
+        return layout
 
     def is_left(self, page_num):
         """Default behavior is that the first page is on the left.
@@ -1187,7 +1612,8 @@ class FancyPage(PageTemplate):
             - styles.bs
         )
         # Adjust gutter margins
-        if self.is_left(doc.page):  # Left page
+        left = self.is_left(doc.page)
+        if left:  # Left page
             x1 = styles.lm
         else:  # Right page
             x1 = styles.lm + styles.gm
@@ -1197,31 +1623,20 @@ class FancyPage(PageTemplate):
         if 'background' in self.template:
             self.draw_background('background', canv)
 
-        self.frames = []
         if 'frames' not in self.template:
             log.error('No frames in template')
             sys.exit(1)
 
-        for frame in self.template['frames']:
-            frame = frame[:]
-            while len(frame) < 8:
-                # This is the default in SmartFrame. At some point in the future we
-                # may want to change this to 0.
-                frame.append(6)
-            self.frames.append(
-                SmartFrame(
-                    self,
-                    styles.adjustUnits(frame[0], self.tw) + x1,
-                    styles.adjustUnits(frame[1], self.th) + y1,
-                    styles.adjustUnits(frame[2], self.tw),
-                    styles.adjustUnits(frame[3], self.th),
-                    leftPadding=styles.adjustUnits(frame[4], self.tw),
-                    bottomPadding=styles.adjustUnits(frame[5], self.th),
-                    rightPadding=styles.adjustUnits(frame[6], self.tw),
-                    topPadding=styles.adjustUnits(frame[7], self.th),
-                    showBoundary=self.show_frame,
-                )
-            )
+        # The frames only depend on these, so each layout is worked out
+        # once, but every page needs frames of its own.
+        key = (tname, left, self.hh, self.fh)
+        layout = self.frame_layouts.get(key)
+        if layout is None:
+            layout = self.frame_layouts[key] = self.layout_frames(x1, y1)
+        self.frames = [
+            SmartFrame(self, *geometry, showBoundary=self.show_frame)
+            for geometry in layout
+        ]
         canv.firstSect = True
         canv._pagenum = doc.page
         for frame in self.frames:
@@ -1443,6 +1858,165 @@ def parse_commandline():
         help='Support embedding raw HTML. Default=%s' % def_raw_html,
     )
 
+    def_inline_fragments = config.getValue("general", "inline_fragments", False)
+    parser.add_option(
+        '--inline-fragments',
+        action="store_true",
+        dest='inline_fragments',
+        default=def_inline_fragments,
+        help='Build paragraph fragments directly from the document '
+        'instead of parsing their markup. Default=%s' % def_inline_fragments,
+    )
+
+    def_paragraph_cache_size = config.getValue("general", "paragraph_cache_size", 0)
+    parser.add_option(
+        '--paragraph-cache-size',
+        dest='paragraph_cache_size',
+        metavar='N',
+        default=def_paragraph_cache_size,
+        help='Reuse the line breaks of up to N distinct paragraphs for '
+        'identical ones. 0 disables it. Default=%s' % def_paragraph_cache_size,
+    )
+
+    def_reserve_toc = config.getValue("general", "reserve_toc", False)
+    parser.add_option(
+        '--reserve-toc',
+        action="store_true",
+        dest='reserve_toc',
+        default=def_reserve_toc,
+        help='Make room for the whole table of contents before the first '
+        'pass, which usually saves one pass. When chapters start on new '
+        'pages, lay them out first to find their page numbers too. '
+        'Default=%s' % def_reserve_toc,
+    )
+
+    def_layout_jobs = config.getValue("general", "layout_jobs", 1)
+    parser.add_option(
+        '--layout-jobs',
+        dest='layout_jobs',
+        metavar='N',
+        default=def_layout_jobs,
+        help='Lay out the chapters for --reserve-toc in N processes, where '
+        'processes can be forked safely. 1 lays them out in this one. '
+        'Default=%s' % def_layout_jobs,
+    )
+
+    def_layout_cache = config.getValue("general", "layout_cache", None)
+    parser.add_option(
+        '--layout-cache',
+        dest='layout_cache',
+        metavar='FILE',
+        default=def_layout_cache,
+        help='Keep the page numbers found by laying out the chapters for '
+        '--reserve-toc in FILE, so the next build only lays out again the '
+        'chapters that changed. The PDF is still built in full. '
+        'Default=%s' % def_layout_cache,
+    )
+
+    def_doctree_cache = config.getValue("general", "doctree_cache", None)
+    parser.add_option(
+        '--doctree-cache',
+        dest='doctree_cache',
+        metavar='DIR',
+        default=def_doctree_cache,
+        help='Keep the parsed documents in DIR, so sources that did not '
+        'change are not parsed again. Default=%s' % def_doctree_cache,
+    )
+
+    def_flowable_cache = config.getValue("general", "flowable_cache", None)
+    parser.add_option(
+        '--flowable-cache',
+        dest='flowable_cache',
+        metavar='DIR',
+        default=def_flowable_cache,
+        help='Keep the flowables made out of each top level section in DIR, '
+        'so sections that did not change are not processed again. '
+        'Default=%s' % def_flowable_cache,
+    )
+
+    def_skip_unchanged = config.getValue("general", "skip_unchanged", False)
+    parser.add_option(
+        '--skip-unchanged',
+        action='store_true',
+        dest='skip_unchanged',
+        default=def_skip_unchanged,
+        help='Do not build the PDF if neither its sources, stylesheets, '
+        'fonts, images nor options changed since it was last built. '
+        'Default=%s' % def_skip_unchanged,
+    )
+
+    def_max_pages = config.getValue("general", "max_pages", 0)
+    parser.add_option(
+        '--max-pages',
+        dest='max_pages',
+        metavar='N',
+        default=def_max_pages,
+        help='Stop after the first N pages, leaving the rest of the document '
+        'out, to preview it quickly. 0 means all pages. Default=%s' % def_max_pages,
+    )
+
+    def_stream = config.getValue("general", "stream", False)
+    parser.add_option(
+        '--stream',
+        action='store_true',
+        dest='stream',
+        default=def_stream,
+        help='Make each top level section into flowables only when the build '
+        'gets to it, and let go of it once it is laid out, so big documents '
+        'need less memory. Only for documents built in a single pass: without '
+        'a table of contents, total page counts, real footnotes or floating '
+        'images. Default=%s' % def_stream,
+    )
+
+    parser.add_option(
+        '--dry-run-layout',
+        action='store_true',
+        dest='dry_run_layout',
+        default=False,
+        help='Lay the document out without drawing it or writing the PDF, '
+        'and print the number of pages, the page of each heading and the '
+        'warnings as JSON.',
+    )
+
+    parser.add_option(
+        '--watch',
+        action='store_true',
+        dest='watch',
+        default=False,
+        help='Build the PDF, and build it again every time its source, '
+        'stylesheets, fonts, images or templates change, until interrupted.',
+    )
+
+    parser.add_option(
+        '--profile-phases',
+        action='store_true',
+        dest='profile_phases',
+        default=False,
+        help='Print the wall time, CPU time and peak traced memory of each '
+        'phase of the build: loading stylesheets and fonts, parsing, making '
+        'flowables, each pass of the layout and saving the PDF.',
+    )
+
+    parser.add_option(
+        '--profile-handlers',
+        action='store_true',
+        dest='profile_handlers',
+        default=False,
+        help='Print how many nodes each node handler made flowables or text '
+        'out of, and how long it took, and how long the nodes in each range '
+        'of source lines took, the slowest first.',
+    )
+
+    parser.add_option(
+        '--profile-format',
+        dest='profile_format',
+        metavar='FORMAT',
+        choices=['text', 'json'],
+        default='text',
+        help='Print what --profile-phases and --profile-handlers found out as '
+        'text or json. Default=text',
+    )
+
     parser.add_option(
         '-q',
         '--quiet',
@@ -1772,47 +2346,115 @@ def main(_args=None):
 
     add_extensions(options)
 
-    return_code = RstToPdf(
-        stylesheets=options.style,
-        language=options.language,
-        header=options.header,
-        footer=options.footer,
-        inlinelinks=options.inlinelinks,
-        breaklevel=int(options.breaklevel),
-        baseurl=options.baseurl,
-        fit_mode=options.fit_mode,
-        background_fit_mode=options.background_fit_mode,
-        smarty=str(options.smarty),
-        font_path=options.fpath,
-        style_path=options.stylepath,
-        repeat_table_rows=options.repeattablerows,
-        footnote_backlinks=options.footnote_backlinks,
-        inline_footnotes=options.inline_footnotes,
-        real_footnotes=options.real_footnotes,
-        def_dpi=int(options.def_dpi),
-        basedir=options.basedir,
-        show_frame=options.show_frame,
-        splittables=options.splittables,
-        blank_first_page=options.blank_first_page,
-        first_page_on_right=options.first_page_on_right,
-        breakside=options.breakside,
-        custom_cover=options.custom_cover,
-        floating_images=options.floating_images,
-        numbered_links=options.numbered_links,
-        raw_html=options.raw_html,
-        section_header_depth=int(options.section_header_depth),
-        strip_elements_with_classes=options.strip_elements_with_classes,
-        record_dependencies=options.record_dependencies,
-    ).createPdf(
+    def make_client():
+        return RstToPdf(
+            stylesheets=options.style,
+            language=options.language,
+            header=options.header,
+            footer=options.footer,
+            inlinelinks=options.inlinelinks,
+            breaklevel=int(options.breaklevel),
+            baseurl=options.baseurl,
+            fit_mode=options.fit_mode,
+            background_fit_mode=options.background_fit_mode,
+            smarty=str(options.smarty),
+            font_path=options.fpath,
+            style_path=options.stylepath,
+            repeat_table_rows=options.repeattablerows,
+            footnote_backlinks=options.footnote_backlinks,
+            inline_footnotes=options.inline_footnotes,
+            real_footnotes=options.real_footnotes,
+            def_dpi=int(options.def_dpi),
+            basedir=options.basedir,
+            show_frame=options.show_frame,
+            splittables=options.splittables,
+            blank_first_page=options.blank_first_page,
+            first_page_on_right=options.first_page_on_right,
+            breakside=options.breakside,
+            custom_cover=options.custom_cover,
+            floating_images=options.floating_images,
+            numbered_links=options.numbered_links,
+            raw_html=options.raw_html,
+            section_header_depth=int(options.section_header_depth),
+            strip_elements_with_classes=options.strip_elements_with_classes,
+            record_dependencies=options.record_dependencies,
+            inline_fragments=options.inline_fragments,
+            paragraph_cache_size=int(options.paragraph_cache_size),
+            reserve_toc=options.reserve_toc,
+            layout_jobs=int(options.layout_jobs),
+            layout_cache=options.layout_cache,
+            doctree_cache=options.doctree_cache,
+            flowable_cache=options.flowable_cache,
+            dry_run_layout=options.dry_run_layout,
+            max_pages=int(options.max_pages),
+            stream=options.stream,
+            profile_phases=options.profile_phases,
+            profile_handlers=options.profile_handlers,
+        )
+
+    def print_profile(client):
+        # Not to stdout, where the PDF may go
+        for profile in client.phase_profile, client.handler_profile:
+            if profile is not None:
+                print(profile.report(options.profile_format), file=sys.stderr)
+
+    if options.dry_run_layout:
+        client = make_client()
+        return_code, summary = dry_run_layout(
+            client, options.infile.read(), options.infile.name
+        )
+        if close_infile:
+            infile.close()
+        print(json.dumps(summary, indent=1))
+        print_profile(client)
+        sys.exit(return_code)
+
+    if options.watch:
+        if not filename or not isinstance(outfile, str):
+            log.critical('--watch needs an input and an output file')
+            sys.exit(1)
+        infile.close()
+
+        def build(client):
+            with open(filename, 'rb') as f:
+                text = f.read()
+            return client.createPdf(
+                text=text,
+                source_path=filename,
+                output=outfile,
+                compressed=options.compressed,
+            )
+
+        sys.exit(watch(filename, outfile, make_client, build))
+
+    digest = None
+    if options.skip_unchanged and filename and isinstance(outfile, str):
+        digest = options_digest(options, filename)
+        if up_to_date(outfile, digest):
+            if not options.quiet:
+                print('%s is up to date' % outfile)
+            infile.close()
+            sys.exit(0)
+
+    client = make_client()
+    return_code = client.createPdf(
         text=options.infile.read(),
         source_path=options.infile.name,
         output=options.outfile,
         compressed=options.compressed,
     )
+    print_profile(client)
 
     if close_infile:
         infile.close()
 
+    if digest is not None and return_code == 0:
+        write_manifest(
+            outfile,
+            digest,
+            [filename] + client.record_dependencies.list,
+        )
+
     sys.exit(return_code)
 
 
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+An on-disk cache of parsed doctrees.
+
+Parsing is a good share of the time it takes to build a large document,
+and most of the time its sources didn't change since the last build,
+only, say, the stylesheet did. Doctrees can be pickled, so this keeps
+them in a directory, by a digest of their source and of everything
+else the parser depends on: the versions of docutils and rst2pdf, the
+settings the document is parsed with, and the directives and roles
+rst2pdf and its extensions added.
+
+Files the source includes are only known once it's parsed, so their
+digests are kept along with the doctree, and a doctree is not used if
+any of them changed.
+'''
+
+import hashlib
+import os
+import pickle
+
+import docutils
+from docutils import transforms, utils
+from docutils.parsers.rst import directives, roles
+
+from . import version
+from .log import log
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class DoctreeCache(object):
+    """Doctrees pickled in directory, see key() for what they are kept
+    by."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, *parts):
+        """A key for the doctree parsed out of parts, which are the
+        source text and whatever else parsing it depends on."""
+        digest = hashlib.sha1(
+            repr(
+                (
+                    docutils.__version__,
+                    version,
+                    sorted(
+                        set(directives._directives)
+                        - set(directives._directive_registry)
+                    ),
+                    sorted(set(roles._roles) - set(roles._role_registry)),
+                )
+            ).encode()
+        )
+        for part in parts:
+            digest.update(repr(part).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """The doctree kept for key, or None."""
+        try:
+            with open(self._path(key), 'rb') as f:
+                dependencies, doctree = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning('Cannot read cached doctree %s: %s', self._path(key), e)
+            return None
+        for path, digest in dependencies:
+            if _file_digest(path) != digest:
+                log.debug('%s changed, parsing again', path)
+                return None
+        # What put() left out
+        doctree.settings.record_dependencies = utils.DependencyList(
+            None, [path for path, digest in dependencies]
+        )
+        doctree.reporter = utils.new_reporter(doctree['source'], doctree.settings)
+        doctree.transformer = transforms.Transformer(doctree)
+        return doctree
+
+    def put(self, key, doctree):
+        """Keep doctree for key. Call it before anything changes it."""
+        settings = doctree.settings
+        dependencies = [
+            (path, _file_digest(path)) for path in settings.record_dependencies.list
+        ]
+        # The reporter and transformer don't pickle, and get() makes
+        # new ones, along with the dependencies
+        saved = doctree.reporter, doctree.transformer, settings.record_dependencies
+        doctree.reporter = doctree.transformer = None
+        settings.record_dependencies = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            data = pickle.dumps((dependencies, doctree), pickle.HIGHEST_PROTOCOL)
+            # So builds running at the same time never see half a file
+            temp = '%s.%d' % (self._path(key), os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self._path(key))
+        except Exception as e:
+            log.warning('Cannot cache doctree in %s: %s', self.directory, e)
+        finally:
+            doctree.reporter, doctree.transformer, settings.record_dependencies = saved
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Lay a document out without making a PDF of it.
+
+To check that a document lays out, how many pages it has and where its
+headings land, the flowables don't need to be drawn nor the PDF
+written. dry_run_layout builds the document with a LayoutCanvas, which
+neither draws images nor saves anything, so fonts and images are never
+embedded, and sums up what the layout found out.
+'''
+
+from io import BytesIO
+import logging
+
+from reportlab.platypus.doctemplate import LayoutError
+
+from .log import log
+
+
+class _Warnings(logging.Handler):
+    """Keeps the warnings and errors logged while it's added to log."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def dry_run_layout(client, text, source_path=None):
+    """Lay text out with client, which must have been made with
+    dry_run_layout=True, without drawing or saving it.
+
+    Returns (return code, summary), where summary is a dict with the
+    number of pages, of passes it took, the page of each heading, what
+    was logged as a warning or an error, and the layout error, if any.
+    """
+    warnings = _Warnings()
+    log.addHandler(warnings)
+    error = None
+    try:
+        return_code = client.createPdf(
+            text=text, source_path=source_path, output=BytesIO()
+        )
+    except LayoutError as e:
+        return_code = 1
+        error = str(e)
+    except SystemExit as e:
+        # Some errors, like a literal block too wide for the frame with
+        # fit_literal_mode=error, log what went wrong and exit
+        return_code = e.code if isinstance(e.code, int) else 1
+        error = warnings.messages[-1] if warnings.messages else None
+    finally:
+        log.removeHandler(warnings)
+    summary = {'pages': 0, 'passes': 0, 'headings': []}
+    summary.update(getattr(client, 'layout_summary', {}))
+    summary['warnings'] = warnings.messages
+    summary['error'] = error
+    return return_code, summary
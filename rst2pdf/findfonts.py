@@ -23,6 +23,7 @@ from reportlab.pdfbase.ttfonts import (
 )
 
 from rst2pdf.log import log
+from rst2pdf.phases import timed
 
 flist = []
 afmList = []
@@ -158,6 +159,7 @@ def loadFonts():
                 families[family][0] = fontName
 
 
+@timed('fonts')
 def findFont(fname):
     loadFonts()
     # So now we are sure we know the families and font
@@ -276,6 +278,7 @@ def findTTFont(fname):
         return variants
 
 
+@timed('fonts')
 def autoEmbed(fname):
     """Given a font name, does a best-effort of embedding
     said font and its variants.
@@ -347,6 +350,7 @@ def autoEmbed(fname):
     return fontList
 
 
+@timed('fonts')
 def guessFont(fname):
     """Given a font name like "Tahoma-BoldOblique", "Bitstream Charter Italic"
     or "Perpetua Bold Italic" guess what it means.
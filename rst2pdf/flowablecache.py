@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+An on-disk cache of the flowables made out of top level sections.
+
+Turning the doctree into flowables runs a node handler for every node
+in it, which is a good share of the build time. When a chapter of a long
+document changes, the other chapters make the same flowables as last
+time, so this keeps the flowables of each top level section, pickled, by
+a digest of the section and of everything else they depend on (see
+FlowableCache.key).
+
+Flowables point at the client, its styles and doctree nodes. Those are
+pickled by reference: the client and its stylesheet as themselves,
+styles by name, and nodes by their path from the section, so they are
+the ones of the current build when the flowables are loaded again.
+
+Besides making flowables, handlers keep track of anchors, endnotes and
+the files they use in the client, which is replayed for cached sections.
+A section whose handlers change anything else in the client, or whose
+flowables can't be pickled, is not cached.
+'''
+
+import hashlib
+import itertools
+import os
+import pickle
+
+from docutils import nodes
+
+from .chapters import file_stamp, fingerprint
+from .log import log
+from .orderedset import OrderedSet
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def _child_index(parent, child):
+    for i, c in enumerate(parent.children):
+        if c is child:
+            return i
+    raise _Uncacheable('%r is not a child of its parent' % child)
+
+
+def _node_path(section, node):
+    """The indexes of the children from section down to node."""
+    path = []
+    while node is not section:
+        parent = node.parent
+        if parent is None:
+            raise _Uncacheable('%r is not in the section' % node)
+        path.append(_child_index(parent, node))
+        node = parent
+    return tuple(reversed(path))
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, client, section):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.client = client
+        self.section = section
+        self.styles = {
+            id(style): name for name, style in client.styles.StyleSheet.byName.items()
+        }
+
+    def persistent_id(self, obj):
+        if obj is self.client:
+            return ('client',)
+        if obj is self.client.styles:
+            return ('styles',)
+        if isinstance(obj, nodes.Node):
+            return ('node', _node_path(self.section, obj))
+        name = self.styles.get(id(obj))
+        if name is not None:
+            return ('style', name)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, client, section):
+        super().__init__(file)
+        self.client = client
+        self.section = section
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == 'client':
+            return self.client
+        if kind == 'styles':
+            return self.client.styles
+        if kind == 'style':
+            return self.client.styles.StyleSheet[pid[1]]
+        node = self.section
+        for i in pid[1]:
+            node = node.children[i]
+        return node
+
+
+# What handlers may change in the client, and put back for cached sections
+_REPLAYED = {'targets', 'pending_targets', 'decoration', 'depth'}
+
+# Bumped when what is kept for a section changes
+_FORMAT = 3
+
+
+def _state(client):
+    """What a section's handlers could change in client, besides what
+    is replayed."""
+    state = {}
+    for name, value in vars(client).items():
+        if name in _REPLAYED:
+            continue
+        size = len(value) if isinstance(value, (list, dict, set)) else None
+        simple = value if isinstance(value, (bool, int, float, str)) else None
+        state[name] = (id(value), simple, size)
+    decoration = client.decoration
+    state['decoration'] = sorted(
+        (name, id(value)) for name, value in decoration.items() if name != 'endnotes'
+    )
+    state['styles'] = len(client.styles.StyleSheet.byName)
+    return state
+
+
+class FlowableCache(object):
+    """The flowables of top level sections, pickled in directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._fingerprint = None
+        self.hits = self.misses = 0
+
+    def key(self, client, section):
+        """A digest of section and of what its flowables depend on.
+
+        Those are the options, stylesheets and fonts (see
+        chapters.fingerprint), how deep the section is, the anchors
+        still waiting for a flowable, and the images it uses.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(client)
+        digest = hashlib.sha1(
+            repr(
+                (
+                    _FORMAT,
+                    self._fingerprint,
+                    client.depth,
+                    list(client.pending_targets),
+                )
+            ).encode()
+        )
+        digest.update(section.pformat().encode())
+        for image in section.findall(nodes.image):
+            uri = os.path.join(client.basedir, image['uri'])
+            digest.update(repr(file_stamp(uri)).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def gather_elements(self, client, section, gather):
+        """Return gather(), the flowables for section, or the ones kept
+        for it."""
+        key = self.key(client, section)
+        elements = self.get(key, client, section)
+        if elements is not None:
+            self.hits += 1
+            return elements
+        self.misses += 1
+        targets = len(client.targets)
+        endnotes = len(client.decoration['endnotes'])
+        dependencies = client.record_dependencies
+        files = len(dependencies.list) if dependencies is not None else 0
+        state = _state(client)
+        elements = gather()
+        if _state(client) != state:
+            log.debug('Not caching section %s, it changes the client', key)
+            return elements
+        replay = (
+            list(itertools.islice(client.targets, targets, None)),
+            list(client.pending_targets),
+            client.decoration['endnotes'][endnotes:],
+            dependencies.list[files:] if dependencies is not None else [],
+        )
+        self.put(key, client, section, (elements, replay))
+        return elements
+
+    def get(self, key, client, section):
+        try:
+            with open(self._path(key), 'rb') as f:
+                elements, replay = _Unpickler(f, client, section).load()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning('Cannot read cached section %s: %s', self._path(key), e)
+            return None
+        targets, pending_targets, endnotes, files = replay
+        client.targets.extend(targets)
+        client.pending_targets = OrderedSet(pending_targets)
+        client.decoration['endnotes'].extend(endnotes)
+        if client.record_dependencies is not None:
+            client.record_dependencies.add(*files)
+        return elements
+
+    def put(self, key, client, section, data):
+        # So builds running at the same time never see half a file
+        temp = '%s.%d' % (self._path(key), os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, 'wb') as f:
+                _Pickler(f, client, section).dump(data)
+            os.replace(temp, self._path(key))
+        except Exception as e:
+            log.debug('Cannot cache section %s: %s', key, e)
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
@@ -3,6 +3,8 @@
 
 __docformat__ = 'reStructuredText'
 
+import bisect
+from collections import OrderedDict
 from copy import copy
 import re
 import sys
@@ -26,8 +28,15 @@ from reportlab.platypus.tables import Table, TableStyle
 from reportlab.platypus.tableofcontents import TableOfContents
 from reportlab.platypus.xpreformatted import XPreformatted
 
+try:
+    # How reportlab styles the cells of a table, which ListItem copies
+    from reportlab.platypus.tables import _setCellStyle, CellStyle
+except ImportError:  # Not public, reportlab may drop them
+    _setCellStyle = CellStyle = None
+
 from . import styles
 from .log import log
+from .orderedset import OrderedSet
 
 
 class XXPreformatted(XPreformatted):
@@ -146,6 +155,106 @@ class Heading(Paragraph):
         Paragraph.draw(self)
 
 
+class WrapCache(object):
+    """The line breaks of up to size distinct paragraphs, in a LRU cache
+    keyed by the markup, the style and the available width, for
+    CachedParagraph. hits and misses count the wraps that did (misses)
+    or didn't (hits) break lines.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def _copy_blPara(blPara):
+    """A copy of blPara whose lines can change without changing the
+    lines of blPara."""
+    if blPara.kind == 0:
+        lines = [(extraSpace, list(words)) for extraSpace, words in blPara.lines]
+    else:
+        lines = [line.clone(words=list(line.words)) for line in blPara.lines]
+    return blPara.clone(lines=lines)
+
+
+class CachedParagraph(Paragraph):
+    """A paragraph that can reuse the line breaks of an identical one.
+
+    Generated documents often repeat the same short paragraphs many times
+    (table cells like "N/A" or "Yes", parameter types, boilerplate). What
+    ``wrap`` computes is kept in the client's ``paragraph_cache`` (see
+    WrapCache) and reused by every paragraph with the same key, each with
+    its own copy of the lines.
+    """
+
+    # What Paragraph.wrap leaves on the paragraph, other than the frags,
+    # which stay the paragraph's own.
+    wrap_attrs = (
+        'width',
+        'height',
+        '_wrapWidths',
+        'blPara',
+        '_width_max',
+        '_splitLongWordCount',
+        '_hyphenations',
+    )
+
+    def __init__(self, text, style, bulletText=None, frags=None, client=None):
+        # Split pieces are made without the client
+        self.client = client
+        Paragraph.__init__(self, text, style, bulletText, frags=frags)
+
+    def _wrap_key(self, availWidth):
+        if self.client is None or self.client.paragraph_cache is None:
+            return None
+        if availWidth < _FUZZ:
+            return None
+        # Split pieces have no text, and right to left text is
+        # reversed in place when drawn
+        if not isinstance(self.text, str) or self.style.wordWrap == 'RTL':
+            return None
+        if not (self.bulletText is None or isinstance(self.bulletText, str)):
+            return None
+        if hasattr(self, 'autoLeading'):
+            return None
+        return self.text, self.bulletText, self.style, availWidth
+
+    def wrap(self, availWidth, availHeight):
+        key = self._wrap_key(availWidth)
+        if key is None:
+            return Paragraph.wrap(self, availWidth, availHeight)
+        cache = self.client.paragraph_cache
+        entry = cache.get(key)
+        if entry is not None:
+            self.__dict__.update(entry)
+            self.blPara = _copy_blPara(entry['blPara'])
+            return self.width, self.height
+        size = Paragraph.wrap(self, availWidth, availHeight)
+        entry = {a: self.__dict__[a] for a in self.wrap_attrs if a in self.__dict__}
+        entry['blPara'] = _copy_blPara(self.blPara)
+        cache.put(key, entry)
+        return size
+
+
 class Separation(Flowable):
     """A simple <hr>-like flowable"""
 
@@ -215,16 +324,111 @@ class OddEven(Flowable):
         return []
 
 
+def set_max_page_height_on_flowable(flowable, cell_style, height):
+    """Tell a flowable in a table cell the height it has in a page."""
+    if hasattr(flowable, 'max_page_height'):
+        # Subtract padding from h only if it is a positive value
+        top_padding = cell_style.topPadding if cell_style.topPadding > 0 else 0
+        bottom_padding = cell_style.topPadding if cell_style.bottomPadding > 0 else 0
+
+        h = abs(height - top_padding - bottom_padding) - _FUZZ
+        flowable.max_page_height = h
+
+
+# What laying out a table in windows of rows uses of reportlab's Table.
+# None of it is public, so tables are laid out whole without any of it.
+_WINDOW_INTERNALS = (
+    '_addCommand',
+    '_bkgrndcmds',
+    '_cellStyles',
+    '_cellvalues',
+    '_cr_1_0',
+    '_cr_1_1',
+    '_linecmds',
+    '_nosplitCmds',
+    '_nrows',
+    '_rowHeights',
+    '_spanCmds',
+    '_splitLineCmds',
+    '_srflcmds',
+)
+
+
+class TableLayout(object):
+    """Layout state shared by all the pieces of a long DelayedTable.
+
+    ``table`` is a reportlab Table over all the rows, with the style already
+    applied; the pieces take their cell styles and commands from it instead
+    of restyling the whole table for every page.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        nrows = table._nrows
+        # Measured row heights, one list per set of column widths
+        self.heights = {}
+        # breaks[i] is False if the table can't be cut before row i
+        # because a cell spans across it
+        depth = [0] * (nrows + 1)
+        for _, (sc, sr), (ec, er) in table._spanCmds:
+            if sr < 0:
+                sr += nrows
+            if er < 0:
+                er += nrows
+            if er > sr:
+                depth[sr + 1] += 1
+                depth[er + 1] -= 1
+        self.breaks = []
+        d = 0
+        for i in depth:
+            d += i
+            self.breaks.append(d == 0)
+        # Cells that resize to the available height make row heights
+        # depend on it, too
+        self.by_height = any(
+            hasattr(flowable, 'max_page_height')
+            for row in table._cellvalues
+            for cell in row
+            for flowable in (cell if isinstance(cell, (list, tuple)) else [cell])
+        )
+
+
 class DelayedTable(Table):
     """A flowable that inserts a table for which it has the data.
 
     Needed so column widths can be determined after we know on what frame
     the table will be inserted, thus making the overal table width correct.
 
+    Tables longer than ``window_rows`` are laid out a window of rows at a
+    time: each page only builds a Table over the rows that may end up in
+    it (plus the repeated header rows) and the rest of the table is left
+    to another DelayedTable. Row heights are measured only once, and are
+    shared by all the pieces of the table.
+
+    The Table built for each available size is kept (up to
+    ``wrap_cache_size`` of them), since the same table is often wrapped
+    again and again with the same size, and reused until the rows, widths
+    or style commands change. The ``table_wrap_stats`` of the client, if
+    it's given one, count how many wraps did (misses) or didn't (hits)
+    build a Table.
+
     """
 
-    def __init__(self, data, colWidths, style=None, repeatrows=False, splitByRow=True):
+    window_rows = 64
+    wrap_cache_size = 8
+
+    def __init__(
+        self,
+        data,
+        colWidths,
+        style=None,
+        repeatrows=False,
+        splitByRow=True,
+        client=None,
+    ):
         self.data = data
+        self.client = client
         self._colWidths = colWidths
         if style is None:
             style = TableStyle(
@@ -240,32 +444,207 @@ class DelayedTable(Table):
         self.repeatrows = repeatrows
         self.hAlign = TA_CENTER
         self.splitByRow = splitByRow
+        # The first row of data that goes in this piece of the table, and
+        # the TableLayout shared by all the pieces, if laid out in windows
+        self._start = 0
+        self._layout = None
+        self._wrapped = None
+        # Column widths in points, by available width
+        self._resolved_widths = {}
+        # The wrapped Table, column widths and size, by available size
+        self._tables = {}
+        self._inputs = None
+        self._by_height = None
 
     def wrap(self, w, h):
+        # The rows themselves, not just their number, and the commands of
+        # the style, which may get more of them after it's given
+        inputs = (
+            tuple(self.data),
+            tuple(self._colWidths),
+            tuple(self.style.getCommands()),
+            self.repeatrows,
+        )
+        if inputs != self._inputs:
+            self._inputs = inputs
+            self._tables = {}
+            self._resolved_widths = {}
+            self._by_height = None
+        self._wrapped = w, h
+        stats = getattr(self.client, 'table_wrap_stats', None)
+        if (w, h) in self._tables:
+            if stats is not None:
+                stats['hits'] += 1
+            self.t, self.colWidths, size = self._tables[w, h]
+            if self._has_height_dependent_cells():
+                # They may have been told another height since
+                self._set_max_page_height_on_cell_flowables(h)
+            return size
+        if stats is not None:
+            stats['misses'] += 1
+
         # Create the table, with the widths from colWidths reinterpreted
         # if needed as percentages of frame/cell/whatever width w is.
 
-        # _tw = w/sum(self.colWidths)
-        def adjust(*args, **kwargs):
-            kwargs['total'] = w
-            return styles.adjustUnits(*args, **kwargs)
-
-        # adjust=functools.partial(styles.adjustUnits, total=w)
-        self.colWidths = [adjust(x) for x in self._colWidths]
-        # colWidths = [_w * _tw for _w in self.colWidths]
-        self.t = Table(
-            self.data,
-            colWidths=self.colWidths,
-            style=self.style,
-            repeatRows=self.repeatrows,
-            splitByRow=True,
-        )
+        self.colWidths = self._resolve_col_widths(w)
+        if self._layout or (
+            len(self.data) > self.window_rows and None not in self.colWidths
+        ):
+            self._wrap_window(w, h)
+        else:
+            self.t = Table(
+                self.data,
+                colWidths=self.colWidths,
+                style=self.style,
+                repeatRows=self.repeatrows,
+                splitByRow=True,
+            )
 
-        self._set_max_page_height_on_cell_flowables(h)
+            self._set_max_page_height_on_cell_flowables(h)
 
         # splitByRow=self.splitByRow)
         self.t.hAlign = self.hAlign
-        return self.t.wrap(w, h)
+        size = self.t.wrap(w, h)
+        if len(self._tables) >= self.wrap_cache_size:
+            del self._tables[next(iter(self._tables))]
+        self._tables[w, h] = self.t, self.colWidths, size
+        return size
+
+    def _has_height_dependent_cells(self):
+        """Whether any flowable in the table depends on the page height."""
+        if self._by_height is None:
+            self._by_height = any(
+                hasattr(f, 'max_page_height')
+                for row in self.data
+                for cell in row
+                for f in (cell if isinstance(cell, (list, tuple)) else [cell])
+            )
+        return self._by_height
+
+    def _resolve_col_widths(self, w):
+        """The column widths in points for the available width w.
+
+        They are resolved once per width, and shared by all the pieces of
+        a split table.
+        """
+        if w not in self._resolved_widths:
+            self._resolved_widths[w] = tuple(
+                styles.adjustUnits(x, total=w) for x in self._colWidths
+            )
+        return list(self._resolved_widths[w])
+
+    def _wrap_window(self, w, h):
+        """Set self.t to a table with enough rows to fill the height h.
+
+        Rows are measured as the window grows, and their heights reused by
+        the following windows, including those for the next pages.
+
+        """
+        if self._layout is None:
+            table = Table(
+                self.data,
+                colWidths=self.colWidths,
+                style=self.style,
+                repeatRows=self.repeatrows,
+                splitByRow=True,
+            )
+            if not all(hasattr(table, name) for name in _WINDOW_INTERNALS):
+                # Lay out the whole table, as reportlab would
+                self.t = table
+                self._set_max_page_height_on_cell_flowables(h)
+                return
+            self._layout = TableLayout(table)
+        layout = self._layout
+        nrows = layout.table._nrows
+        key = tuple(self.colWidths)
+        if layout.by_height:
+            key += (h,)
+        if key not in layout.heights:
+            layout.heights[key] = [None] * nrows
+        heights = layout.heights[key]
+
+        head = list(range(int(self.repeatrows))) if self._start else []
+        rows = self.window_rows
+        self._end = self._start
+        while True:
+            self._end = min(self._end + rows, nrows)
+            while not layout.breaks[self._end]:
+                self._end += 1
+            self.t = self._window(head, heights)
+            self._set_max_page_height_on_cell_flowables(h)
+            height = self.t.wrap(w, h)[1]
+            for i, rh in zip(
+                head + list(range(self._start, self._end)), self.t._rowHeights
+            ):
+                if rh is not None:
+                    heights[i] = rh
+            if height > h or self._end == nrows:
+                return
+            rows *= 2
+
+    def _window(self, head, heights):
+        """A Table with the rows head + [self._start, self._end)
+
+        It's styled the same as reportlab styles what's left of a table
+        after splitting it before row self._start.
+
+        """
+        T = self._layout.table
+        start, end = self._start, self._end
+        nrows = T._nrows
+        data = [T._cellvalues[i] for i in head] + T._cellvalues[start:end]
+        t = Table(
+            data,
+            colWidths=self.colWidths,
+            rowHeights=[heights[i] for i in head] + heights[start:end],
+            repeatRows=len(head) if start else self.repeatrows,
+            splitByRow=True,
+            normalizedData=1,
+            cellStyles=[T._cellStyles[i] for i in head] + T._cellStyles[start:end],
+        )
+        if start:
+            for cmds, srfl in (
+                (T._splitLineCmds(start), False),
+                (T._bkgrndcmds, True),
+                (T._spanCmds, False),
+                (T._nosplitCmds, False),
+            ):
+                if head:
+                    t._cr_1_1(start, nrows, head, cmds, 0, _srflMode=srfl)
+                else:
+                    t._cr_1_0(start, cmds, 0, _srflMode=srfl)
+            for c in T._srflcmds:
+                t._addCommand(c)
+                if c[1][1] == 'splitfirst':
+                    (sc, sr), (ec, er) = c[1:3]
+                    t._addCommand((c[0], (sc, 0), (ec, 0)) + tuple(c[3:]))
+        else:
+            for c in (
+                T._linecmds + T._bkgrndcmds + T._spanCmds + T._nosplitCmds + T._srflcmds
+            ):
+                t._addCommand(c)
+
+        if end < nrows:
+            # Commands still count rows up to the end of the whole table
+            n = len(data)
+            total = len(head) + nrows - start
+            for name in ('_linecmds', '_bkgrndcmds', '_spanCmds', '_nosplitCmds'):
+                cmds = []
+                for c in getattr(t, name):
+                    (sc, sr), (ec, er) = c[1:3]
+                    if isinstance(sr, str) or isinstance(er, str):
+                        cmds.append(c)
+                        continue
+                    if sr < 0:
+                        sr += total
+                    if er < 0:
+                        er += total
+                    if sr < n:
+                        cmds.append(
+                            (c[0], (sc, sr), (ec, min(er, n - 1))) + tuple(c[3:])
+                        )
+                setattr(t, name, cmds)
+        return t
 
     def _set_max_page_height_on_cell_flowables(self, height):
         """Iterate over all cells in the table and set the maximum height onto the flowable.
@@ -274,35 +653,35 @@ class DelayedTable(Table):
         then resize itself to a valid height in its wrap() method.
         """
 
-        def set_max_page_height_on_flowable(flowable, cell_style):
-            if hasattr(flowable, 'max_page_height'):
-                # Subtract padding from h only if it is a positive value
-                top_padding = cell_style.topPadding if cell_style.topPadding > 0 else 0
-                bottom_padding = (
-                    cell_style.topPadding if cell_style.bottomPadding > 0 else 0
-                )
-
-                h = abs(height - top_padding - bottom_padding) - _FUZZ
-                flowable.max_page_height = h
-
-        for row_index, row in enumerate(self.data):
+        for row_index, row in enumerate(self.t._cellvalues):
             for col_index, columns in enumerate(row):
                 # columns is either a list or a cell (for a single cell table)
-                if isinstance(columns, list):
+                if isinstance(columns, (list, tuple)):
                     for cell in columns:
                         set_max_page_height_on_flowable(
-                            cell, self.t._cellStyles[row_index][col_index]
+                            cell, self.t._cellStyles[row_index][col_index], height
                         )
                 else:
                     set_max_page_height_on_flowable(
-                        columns, self.t._cellStyles[row_index][col_index]
+                        columns, self.t._cellStyles[row_index][col_index], height
                     )
 
     def split(self, w, h):
         if self.splitByRow:
-            if not self.t:
+            if not self.t or self._layout and self._wrapped != (w, h):
                 self.wrap(w, h)
-            return self.t.split(w, h)
+            result = self.t.split(w, h)
+            if self._layout and len(result) == 2:
+                # Leave the rest of the rows to another piece of this table
+                # instead of the Table reportlab made out of the window
+                rest = copy(self)
+                rest.t = None
+                rest._tables = {}
+                rest._start = self._start + result[0]._nrows
+                if self._start:
+                    rest._start -= int(self.repeatrows)
+                result[1] = rest
+            return result
         else:
             return []
 
@@ -336,12 +715,50 @@ def tablepadding(padding):
     )
 
 
+def _listPrefixHeights(flowables, availWidth, maxHeight=None):
+    """Return the heights of all the prefixes of a list of flowables.
+
+    The kth element is what ``_listWrapOn(flowables[:k], availWidth, None)``
+    would return as height, but each flowable is only wrapped once. If
+    maxHeight is given, stops after the first prefix taller than that.
+    """
+    heights = [0]
+    height = 0
+    spaceAfter = 0
+    atTop = True
+    for f in flowables:
+        if hasattr(f, 'frameAction'):
+            if isinstance(f, Indenter):
+                availWidth -= f.left + f.right
+            heights.append(heights[-1])
+            continue
+        _, h = f.wrapOn(None, availWidth, 0xFFFFFFF)
+        if h <= _FUZZ:
+            heights.append(heights[-1])
+            continue
+        height += h
+        if atTop:
+            atTop = False
+        else:
+            spaceBefore = f.getSpaceBefore()
+            if getattr(f, '_SPACETRANSFER', False):
+                spaceBefore = spaceAfter
+            height += max(spaceBefore - spaceAfter, 0)
+        heights.append(height)
+        if maxHeight is not None and height > maxHeight:
+            break
+        if not getattr(f, '_SPACETRANSFER', False):
+            spaceAfter = f.getSpaceAfter()
+        height += spaceAfter
+    return heights
+
+
 class SplitTable(DelayedTable):
-    def __init__(self, data, colWidths, style, padding=3):
+    def __init__(self, data, colWidths, style, padding=3, client=None):
         if len(data) != 1 or len(data[0]) != 2:
             log.error('SplitTable can only be 1 row and two columns!')
             sys.exit(1)
-        DelayedTable.__init__(self, data, colWidths, style)
+        DelayedTable.__init__(self, data, colWidths, style, client=client)
         self.padding, p1, p2, p3, p4 = tablepadding(padding)
         self.style._cmds.insert(0, p1)
         self.style._cmds.insert(0, p2)
@@ -371,94 +788,378 @@ class SplitTable(DelayedTable):
 
             bullet = self.data[0][0]
             text = self.data[0][1]
-            for l in range(0, len(text)):
-                _, fh = _listWrapOn(text[: l + 1], w - dw, None)
-                if fh + dh > h:
-                    # The lth flowable is the guilty one
-                    # split it
-
-                    _, lh = _listWrapOn(text[:l], w - dw, None)
-                    # Workaround for Issue 180
-                    text[l].wrap(w - dw, h - lh - dh)
-                    l2 = text[l].split(w - dw, h - lh - dh)
-                    if l2 == []:  # Not splittable, push some to next page
-                        if l == 0:  # Can't fit anything, push all to next page
-                            return l2
-
-                        # We reduce the number of items we keep on the
-                        # page for two reasons:
-                        #    1) If an item is associated with the following
-                        #       item (getKeepWithNext() == True), we have
-                        #       to back up to a previous one.
-                        #    2) If we miscalculated the size required on
-                        #       the first page (I dunno why, probably not
-                        #       counting borders properly, but we do
-                        #       miscalculate occasionally).  Seems to
-                        #       have to do with nested tables, so it might
-                        #       be the extra space on the border on the
-                        #       inner table.
-
-                        while l > 0:
-                            if not text[l - 1].getKeepWithNext():
-                                first_t = Table(
-                                    [[bullet, text[:l]]],
-                                    colWidths=self.colWidths,
-                                    style=self.style,
-                                )
-                                _w, _h = first_t.wrap(w, h)
-                                if _h <= h:
-                                    break
-                            l -= 1
-
-                        if l > 0:
-                            # Workaround for Issue 180 with wordaxe:
-                            # if wordaxe is not None:
-                            # l3=[Table([
-                            # [bullet,
-                            # text[:l]]
-                            # ],
-                            # colWidths=self.colWidths,
-                            # style=self.style),
-                            # Table([['',text[l:]]],
-                            # colWidths=self.colWidths,
-                            # style=self.style)]
-                            # else:
-                            l3 = [
-                                first_t,
-                                SplitTable(
-                                    [['', text[l:]]],
-                                    colWidths=self.colWidths,
-                                    style=self.style,
-                                    padding=self.padding,
-                                ),
-                            ]
-                        else:  # Everything flows
-                            l3 = []
-                    else:
-                        l3 = [
-                            Table(
-                                [[bullet, text[:l] + [l2[0]]]],
+            heights = _listPrefixHeights(text, w - dw, h - dh)
+            # The first flowable that doesn't fit
+            l = max(bisect.bisect_right(heights, h - dh), 1) - 1
+            if l < len(text):
+                # The lth flowable is the guilty one
+                # split it
+
+                lh = heights[l]
+                # Workaround for Issue 180
+                text[l].wrap(w - dw, h - lh - dh)
+                l2 = text[l].split(w - dw, h - lh - dh)
+                if l2 == []:  # Not splittable, push some to next page
+                    if l == 0:  # Can't fit anything, push all to next page
+                        return l2
+
+                    # We reduce the number of items we keep on the
+                    # page for two reasons:
+                    #    1) If an item is associated with the following
+                    #       item (getKeepWithNext() == True), we have
+                    #       to back up to a previous one.
+                    #    2) If we miscalculated the size required on
+                    #       the first page (I dunno why, probably not
+                    #       counting borders properly, but we do
+                    #       miscalculate occasionally).  Seems to
+                    #       have to do with nested tables, so it might
+                    #       be the extra space on the border on the
+                    #       inner table.
+
+                    while l > 0:
+                        if not text[l - 1].getKeepWithNext():
+                            first_t = Table(
+                                [[bullet, text[:l]]],
                                 colWidths=self.colWidths,
-                                rowHeights=[h],
                                 style=self.style,
                             )
+                            _w, _h = first_t.wrap(w, h)
+                            if _h <= h:
+                                break
+                        l -= 1
+
+                    if l > 0:
+                        # Workaround for Issue 180 with wordaxe:
+                        # if wordaxe is not None:
+                        # l3=[Table([
+                        # [bullet,
+                        # text[:l]]
+                        # ],
+                        # colWidths=self.colWidths,
+                        # style=self.style),
+                        # Table([['',text[l:]]],
+                        # colWidths=self.colWidths,
+                        # style=self.style)]
+                        # else:
+                        l3 = [
+                            first_t,
+                            SplitTable(
+                                [['', text[l:]]],
+                                colWidths=self.colWidths,
+                                style=self.style,
+                                padding=self.padding,
+                                client=self.client,
+                            ),
                         ]
-                        if l2[1:] + text[l + 1 :]:
-                            l3.append(
-                                SplitTable(
-                                    [['', l2[1:] + text[l + 1 :]]],
-                                    colWidths=self.colWidths,
-                                    style=self.style,
-                                    padding=self.padding,
-                                )
+                    else:  # Everything flows
+                        l3 = []
+                else:
+                    l3 = [
+                        Table(
+                            [[bullet, text[:l] + [l2[0]]]],
+                            colWidths=self.colWidths,
+                            rowHeights=[h],
+                            style=self.style,
+                        )
+                    ]
+                    if l2[1:] + text[l + 1 :]:
+                        l3.append(
+                            SplitTable(
+                                [['', l2[1:] + text[l + 1 :]]],
+                                colWidths=self.colWidths,
+                                style=self.style,
+                                padding=self.padding,
+                                client=self.client,
                             )
-                    return l3
+                        )
+                return l3
             log.debug("Can't split splittable")
             return self.t.split(w, h)
         else:
             return DelayedTable.split(self, w, h)
 
 
+class ListItem(Flowable):
+    """A list item: the bullet, and the item's content hanging beside it.
+
+    Lays out like a one row, two column SplitTable (or DelayedTable, when
+    not splittable) with the same style would, but it doesn't build any
+    Table: long and deeply nested lists make thousands of them.
+    Only the cell style commands (fonts, alignment and paddings) can be
+    used, see ListItem.handles.
+
+    """
+
+    cell_ops = frozenset(
+        [
+            'FONT',
+            'FONTNAME',
+            'FACE',
+            'SIZE',
+            'FONTSIZE',
+            'LEADING',
+            'TEXTCOLOR',
+            'ALIGN',
+            'ALIGNMENT',
+            'VALIGN',
+            'LEFTPADDING',
+            'RIGHTPADDING',
+            'TOPPADDING',
+            'BOTTOMPADDING',
+        ]
+    )
+
+    def __init__(self, bullet, content, colWidths, style, splittable=True, padding=3):
+        self.bullet = bullet
+        self.content = content
+        self._colWidths = colWidths
+        self.style = style
+        self.splittable = splittable
+        self.hAlign = TA_CENTER
+        # The row height, when it's fixed
+        self.rowHeight = None
+        # Pieces of a split item keep the widths they are first wrapped
+        # with, just like the Tables SplitTable splits into do
+        self._freeze_widths = False
+        self._resolved_widths = {}
+        # Measured heights, by column widths (and available height, when
+        # some flowable in it depends on it)
+        self._heights = {}
+
+        commands = style.getCommands()
+        if splittable:
+            self.padding, p1, p2, p3, p4 = tablepadding(padding)
+            commands = [p4, p3, p2, p1] + list(commands)
+        self.cellStyles = [CellStyle(repr((0, j))) for j in range(2)]
+        for command in commands:
+            (op, (sc, sr), (ec, er)), values = command[:3], command[3:]
+            if sc < 0:
+                sc += 2
+            if ec < 0:
+                ec += 2
+            if sr < 0:
+                sr += 1
+            if er < 0:
+                er += 1
+            if max(0, sr) > min(0, er):
+                continue
+            for j in range(max(0, sc), min(1, ec) + 1):
+                _setCellStyle([self.cellStyles], 0, j, op, values)
+
+    @classmethod
+    def handles(cls, content, colWidths, style):
+        """Whether a ListItem can stand in for a table with this data."""
+        if _setCellStyle is None:
+            return False
+        if colWidths[0] is None:
+            return False
+        for command in style.getCommands():
+            if command[0] not in cls.cell_ops:
+                return False
+            for c, r in command[1:3]:
+                if not isinstance(c, int) or not isinstance(r, int):
+                    return False
+        for f in content:
+            if (
+                not isinstance(f, Flowable)
+                or isinstance(f, Indenter)
+                or getattr(f, '__split_only__', None)
+            ):
+                return False
+        return True
+
+    def identity(self, maxLen=None):
+        return "<%s at %s%s%s> containing: %s" % (
+            self.__class__.__name__,
+            hex(id(self)),
+            self._frameName(),
+            getattr(self, 'name', '')
+            and (' name="%s"' % getattr(self, 'name', ''))
+            or '',
+            repr(self.content)[:180],
+        )
+
+    def _resolve_col_widths(self, w):
+        """The column widths in points for the available width w.
+
+        Only the bullet's width is mandatory, the content takes the rest.
+        """
+        if w not in self._resolved_widths:
+            widths = [styles.adjustUnits(x, total=w) for x in self._colWidths]
+            self._resolved_widths[w] = widths
+        return self._resolved_widths[w]
+
+    def _cell_geom(self, cell, w, s, aH=72000, maxHeight=None, W=None, H=None):
+        """The height of a cell's content, as a Table measures it.
+
+        If maxHeight is given, stops measuring once the content is taller.
+        """
+        aW = w - s.leftPadding - s.rightPadding
+        aH = aH - s.topPadding - s.bottomPadding
+        t = 0
+        sb0 = sa = None
+        for f in cell:
+            fw, fh = f.wrapOn(getattr(self, 'canv', None), aW, aH)
+            sb = f.getSpaceBefore()
+            sa = f.getSpaceAfter()
+            if W is not None:
+                W.append(fw)
+                H.append(fh)
+            t += fh + sa + sb
+            if sb0 is None:
+                sb0 = sb
+            if maxHeight is not None and t - sb0 - sa > maxHeight:
+                break
+        if sb0 is None:
+            return 0
+        return t - sb0 - sa
+
+    def wrap(self, w, h):
+        if not self._freeze_widths or not hasattr(self, 'colWidths'):
+            bw, cw = self._resolve_col_widths(w)
+            if cw is None:
+                cw = w - bw
+            self.colWidths = [bw, cw]
+        self.width = sum(self.colWidths)
+        if self.rowHeight is not None:
+            self.height = self.rowHeight
+            return self.width, self.height
+
+        # Nested lists get wrapped over and over by the items containing
+        # them, so remember what this one measured at these widths
+        key = tuple(self.colWidths)
+        cells = [self.bullet] + self.content
+        if any(hasattr(f, 'max_page_height') for f in cells):
+            key += (h,)
+        if key in self._heights:
+            height, complete = self._heights[key]
+            if complete or height > h:
+                self.height = height
+                return self.width, self.height
+
+        bstyle, cstyle = self.cellStyles
+        if self.bullet is None:
+            bh = bstyle.leading or 1.2 * bstyle.fontsize
+        else:
+            set_max_page_height_on_flowable(self.bullet, bstyle, h)
+            bh = self._cell_geom([self.bullet], self.colWidths[0], bstyle)
+        bh += bstyle.topPadding + bstyle.bottomPadding
+        for f in self.content:
+            set_max_page_height_on_flowable(f, cstyle, h)
+        # Stop measuring content that is not going to fit anyway
+        padding = cstyle.topPadding + cstyle.bottomPadding
+        ch = self._cell_geom(
+            self.content, self.colWidths[1], cstyle, maxHeight=h - padding
+        )
+        self.height = max(0, bh, ch + padding)
+        self._heights[key] = self.height, ch <= h - padding
+        return self.width, self.height
+
+    def draw(self):
+        canv = self.canv
+        colpos = 0
+        cur = None
+        for cell, s, colwidth in zip(
+            [self.bullet, self.content], self.cellStyles, self.colWidths
+        ):
+            if cur is None or s.color != cur.color:
+                canv.setFillColor(s.color)
+            if (
+                cur is None
+                or s.leading != cur.leading
+                or s.fontname != cur.fontname
+                or s.fontsize != cur.fontsize
+            ):
+                canv.setFont(s.fontname, s.fontsize, s.leading)
+            cur = s
+            if cell is not None:
+                if not isinstance(cell, (list, tuple)):
+                    cell = [cell]
+                self._draw_cell(cell, s, colpos, colwidth)
+            colpos += colwidth
+
+    def _draw_cell(self, cell, s, colpos, colwidth):
+        rowheight = self.height
+        W = []
+        H = []
+        h = self._cell_geom(cell, colwidth, s, aH=rowheight, W=W, H=H)
+        if s.valign == 'TOP':
+            y = rowheight - s.topPadding
+        elif s.valign == 'BOTTOM':
+            y = s.bottomPadding + h
+        else:
+            y = (rowheight + s.bottomPadding - s.topPadding + h) / 2.0
+        if cell:
+            y += cell[0].getSpaceBefore()
+        for f, fw, fh in zip(cell, W, H):
+            if s.alignment == 'LEFT':
+                x = colpos + s.leftPadding
+            elif s.alignment == 'RIGHT':
+                x = colpos + colwidth - s.rightPadding - fw
+            else:
+                x = colpos + (colwidth + s.leftPadding - s.rightPadding - fw) / 2.0
+            y -= f.getSpaceBefore()
+            y -= fh
+            f.drawOn(self.canv, x, y)
+            y -= f.getSpaceAfter()
+
+    def _piece(self, w, bullet, content, rowHeight=None, frozen=True):
+        piece = copy(self)
+        piece._colWidths = self._resolve_col_widths(w)
+        piece._resolved_widths = {}
+        piece._heights = {}
+        del piece.colWidths
+        piece.bullet = bullet
+        piece.content = content
+        piece.rowHeight = rowHeight
+        piece._freeze_widths = frozen
+        return piece
+
+    def split(self, w, h):
+        _w, _h = self.wrap(w, h)
+        if _h <= h:
+            return [self]
+        if not self.splittable or self._freeze_widths:
+            return []
+
+        # Works just like SplitTable.split
+        dw = self.colWidths[0] + self.padding[1] + self.padding[3]
+        dh = self.padding[0] + self.padding[2]
+
+        text = self.content
+        heights = _listPrefixHeights(text, w - dw, h - dh)
+        # The first flowable that doesn't fit
+        l = max(bisect.bisect_right(heights, h - dh), 1) - 1
+        if l >= len(text):
+            log.debug("Can't split list item")
+            return []
+
+        lh = heights[l]
+        # Workaround for Issue 180
+        text[l].wrap(w - dw, h - lh - dh)
+        l2 = text[l].split(w - dw, h - lh - dh)
+        if l2 == []:  # Not splittable, push some to next page
+            if l == 0:  # Can't fit anything, push all to next page
+                return l2
+            # Back up over items kept with the next one, and over
+            # miscalculated sizes (see SplitTable.split)
+            while l > 0:
+                if not text[l - 1].getKeepWithNext():
+                    first = self._piece(w, self.bullet, text[:l])
+                    _w, _h = first.wrap(w, h)
+                    if _h <= h:
+                        break
+                l -= 1
+            if l > 0:
+                return [first, self._piece(w, None, text[l:], frozen=False)]
+            return []  # Everything flows
+
+        l3 = [self._piece(w, self.bullet, text[:l] + [l2[0]], rowHeight=h)]
+        if l2[1:] + text[l + 1 :]:
+            l3.append(self._piece(w, None, l2[1:] + text[l + 1 :], frozen=False))
+        return l3
+
+
 class MySpacer(Spacer):
     def wrap(self, aW, aH):
         w, h = Spacer.wrap(self, aW, aH)
@@ -1119,31 +1820,76 @@ class MyTableOfContents(TableOfContents):
         self.parent = kwargs.pop('parent')
         TableOfContents.__init__(self, *args, **kwargs)
         # reference ids for which this TOC should be notified
-        self.refids = []
+        self.refids = OrderedSet()
         # revese lookup table from (level, text) to refid
         self.refid_lut = {}
         self.linkColor = "#0000ff"
+        # Which heading nodes are inside self.parent, so each
+        # ancestor chain is only walked once
+        self._local = {}
+        # Indexes of the entries that differ from the last pass
+        self._moved = []
+        # Right column styles, and the paragraphs of each column,
+        # reused as long as their text and page number don't change
+        self._right_styles = {}
+        self._left_paras = {}
+        self._right_paras = {}
+        # The rows and width self._table was built for
+        self._table_key = None
+
+    def beforeBuild(self):
+        TableOfContents.beforeBuild(self)
+        self._moved = []
+
+    def islocal(self, node):
+        """See if this node is "local enough" for this TOC.
+        This is for Issue 196"""
+        if self.parent is None:
+            return True
+        try:
+            return self._local[node]
+        except KeyError:
+            pass
+        result = False
+        _node = node
+        while _node.parent:
+            if _node.parent == self.parent:
+                result = True
+                break
+            _node = _node.parent
+        self._local[node] = result
+        return result
 
     def notify(self, kind, stuff):
         # stuff includes (level, text, pagenum, label)
         level, text, pageNum, label, node = stuff
         rlabel = '-'.join(label.split('-')[:-1])
 
-        def islocal(_node):
-            """See if this node is "local enough" for this TOC.
-            This is for Issue 196"""
-            if self.parent is None:
-                return True
-            while _node.parent:
-                if _node.parent == self.parent:
-                    return True
-                _node = _node.parent
-            return False
-
-        if rlabel in self.refids and islocal(node):
+        if rlabel in self.refids and self.islocal(node):
             self.addEntry(level, text, pageNum)
             self.refid_lut[(level, text, pageNum)] = label
 
+    def addEntry(self, level, text, pageNum, key=None):
+        TableOfContents.addEntry(self, level, text, pageNum, key)
+        i = len(self._entries) - 1
+        if i >= len(self._lastEntries) or self._entries[i] != self._lastEntries[i]:
+            self._moved.append(i)
+
+    def rightColStyle(self, left_col_level):
+        """The style for the page numbers, right aligned."""
+        leftColStyle = self.getLevelStyle(left_col_level)
+        key = (left_col_level, leftColStyle)
+        try:
+            return self._right_styles[key]
+        except KeyError:
+            style = self._right_styles[key] = ParagraphStyle(
+                name='leftColLevel%d' % left_col_level,
+                parent=leftColStyle,
+                leftIndent=0,
+                alignment=TA_RIGHT,
+            )
+            return style
+
     def wrap(self, availWidth, availHeight):
         """Adds hyperlink to toc entry."""
 
@@ -1163,36 +1909,71 @@ class MyTableOfContents(TableOfContents):
         else:
             base_level = 0
         tableData = []
+        left_paras, right_paras = {}, {}
         for entry in _tempEntries:
             level, text, pageNum = entry[:3]
             left_col_level = level - base_level
             leftColStyle = self.getLevelStyle(left_col_level)
+            rightColStyle = self.rightColStyle(left_col_level)
             label = self.refid_lut.get((level, text, pageNum), None)
-            if label:
-                pre = u'<a href="#%s" color="%s">' % (label, self.linkColor)
-                post = u'</a>'
-                if isinstance(text, bytes):
-                    text = text.decode('utf-8')
-                text = pre + text + post
-            else:
-                pre = ''
-                post = ''
-            # right col style is right aligned
-            rightColStyle = ParagraphStyle(
-                name='leftColLevel%d' % left_col_level,
-                parent=leftColStyle,
-                leftIndent=0,
-                alignment=TA_RIGHT,
-            )
-            leftPara = Paragraph(text, leftColStyle)
-            rightPara = Paragraph(pre + str(pageNum) + post, rightColStyle)
-            tableData.append([leftPara, rightPara])
 
-        self._table = Table(tableData, colWidths=widths, style=self.tableStyle)
+            # Only the page number changes from one pass to the next,
+            # so the text is kept apart from it
+            key = (text, label, leftColStyle)
+            leftPara = self._left_paras.get(key)
+            if leftPara is None:
+                if label:
+                    pre = u'<a href="#%s" color="%s">' % (label, self.linkColor)
+                    post = u'</a>'
+                    if isinstance(text, bytes):
+                        text = text.decode('utf-8')
+                    text = pre + text + post
+                leftPara = Paragraph(text, leftColStyle)
+            left_paras[key] = leftPara
+            key = (pageNum, label, rightColStyle)
+            rightPara = self._right_paras.get(key)
+            if rightPara is None:
+                if label:
+                    pre = u'<a href="#%s" color="%s">' % (label, self.linkColor)
+                    post = u'</a>'
+                else:
+                    pre = ''
+                    post = ''
+                rightPara = Paragraph(pre + str(pageNum) + post, rightColStyle)
+            right_paras[key] = rightPara
+            tableData.append((leftPara, rightPara))
+        self._left_paras, self._right_paras = left_paras, right_paras
+
+        # Wrapping again with the same entries, as happens on every
+        # pass after the page numbers settle, reuses the same table
+        key = (widths, tableData)
+        if key != self._table_key:
+            self._table = Table(
+                [list(row) for row in tableData],
+                colWidths=widths,
+                style=self.tableStyle,
+            )
+            self._table_key = key
 
         self.width, self.height = self._table.wrapOn(self.canv, availWidth, availHeight)
         return self.width, self.height
 
+    def reserve(self, headings, pages=None):
+        """Fill in the entries for headings before the first pass.
+
+        The page numbers are usually not known yet, but this way the
+        first pass already leaves as much room for the TOC as it will
+        take, instead of laying out everything after a one line
+        placeholder. If they are, pages has one for each heading.
+        Returns the (level, text) of the entries it added, or their
+        (level, text, page number) if pages were given.
+        """
+        for i, h in enumerate(headings):
+            pagenum = pages[i] if pages else 0
+            self.notify('TOCEntry', (h.level, h.text, pagenum, h.parent_id, h.node))
+        n = 3 if pages else 2
+        return [entry[:n] for entry in self._entries]
+
     def split(self, aW, aH):
         # Make sure _table exists before splitting.
         # This was only triggered in rare cases using sphinx.
@@ -1201,22 +1982,20 @@ class MyTableOfContents(TableOfContents):
         return TableOfContents.split(self, aW, aH)
 
     def isSatisfied(self):
-        if self._entries == self._lastEntries:
+        # addEntry kept track of the entries that moved
+        if len(self._entries) != len(self._lastEntries):
+            log.info(
+                'Number of items in TOC changed '
+                'from %d to %d, not satisfied'
+                % (len(self._lastEntries), len(self._entries))
+            )
+            return False
+        if not self._moved:
             log.debug('Table Of Contents is stable')
             return True
-        else:
-            if len(self._entries) != len(self._lastEntries):
-                log.info(
-                    'Number of items in TOC changed '
-                    'from %d to %d, not satisfied'
-                    % (len(self._lastEntries), len(self._entries))
-                )
-                return False
-
-            log.info('TOC entries that moved in this pass:')
-            for i in range(len(self._entries)):
-                if self._entries[i] != self._lastEntries[i]:
-                    log.info(str(self._entries[i]))
-                    log.info(str(self._lastEntries[i]))
 
+        log.info('TOC entries that moved in this pass:')
+        for i in self._moved:
+            log.info(str(self._entries[i]))
+            log.info(str(self._lastEntries[i]))
         return False
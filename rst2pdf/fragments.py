@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Build ReportLab paragraph fragments straight from inline markup tokens.
+
+The inline handlers produce ReportLab mini-markup, which Paragraph then
+feeds character by character through ParaParser, an HTMLParser subclass.
+When the markup is gathered as a list of tokens instead (see
+NodeHandler.tokendispatch), the tags are already separated from the
+text, so it is enough to turn the tokens into the tuple tree that
+ParaParser.tt_parse accepts, and the HTML parsing can be skipped.
+
+paragraph_frags mirrors what Paragraph does with the joined markup
+(whitespace cleanup, entity handling, tag and attribute parsing) so the
+fragments are the same ones the markup path would have produced. Markup
+it is not sure about makes it return None, and the caller should fall
+back to letting Paragraph parse the text.
+'''
+
+from functools import lru_cache
+from html import unescape
+import re
+
+from docutils.utils import smartquotes
+from reportlab.platypus.paragraph import textTransformFrags
+from reportlab.platypus.paraparser import ParaParser, known_entities
+
+_split_tags = re.compile(r'(<[^>]*>)').split
+_entity = re.compile(r'&(?:#([0-9]+)|#x([0-9a-fA-F]+)|([a-zA-Z][-.a-zA-Z0-9]*));')
+_tag = re.compile(r'<(/?)([a-zA-Z][-.a-zA-Z0-9_:]*)((?:\s[^>]*?)?)\s*(/?)>$')
+_attr = re.compile(r'\s*([a-zA-Z_][-.:a-zA-Z0-9_]*)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+# Paragraph only collapses these consistently with str.split when the
+# line has no no-break space, so leave such text to the markup path.
+_odd_space = re.compile('[\xa0\u200b]')
+
+# HTMLParser switches to raw text mode inside these
+_cdata_tags = {'script', 'style'}
+
+
+def markup_tokens(markup):
+    """Split markup into tags and text, dropping empty strings.
+
+    Text tokens never contain '<', so a token is a tag exactly
+    when it starts with '<'.
+    """
+    if '<' not in markup:
+        return [markup] if markup else []
+    return [t for t in _split_tags(markup) if t]
+
+
+@lru_cache(maxsize=1024)
+def tag_tokens(markup):
+    """markup_tokens, for the few distinct strings text is wrapped in."""
+    return tuple(markup_tokens(markup))
+
+
+def educate_tokens(tokens, smarty):
+    """Apply smartypants to tokens, as smartyPants does to their markup.
+
+    Adjacent text tokens are joined first, since that's the text
+    smartyPants sees between two tags.
+    """
+    runs = []
+    text = []
+    for t in tokens:
+        if t[0] == '<':
+            if text:
+                runs.append(('text', ''.join(text)))
+                text = []
+            runs.append(('tag', t))
+        else:
+            text.append(t)
+    if text:
+        runs.append(('text', ''.join(text)))
+    return [t for t in smartquotes.educate_tokens(runs, smarty) if t]
+
+
+def _clean(tokens):
+    """Collapse whitespace the way Paragraph's cleanBlockQuotedText does."""
+    result = []
+    space = False
+    for t in tokens:
+        if t[0] == '<':
+            if space and result:
+                result.append(' ')
+            space = False
+            result.append(' '.join(t.split()))
+            continue
+        words = t.split()
+        if not words:
+            space = True
+            continue
+        if (space or t[0].isspace()) and result:
+            result.append(' ')
+        result.append(' '.join(words))
+        space = t[-1].isspace()
+    return result
+
+
+def _data(text, children):
+    """Append text to children, one piece per HTMLParser data event."""
+    if '&' not in text:
+        children.append(text)
+        return True
+    pos = 0
+    for m in _entity.finditer(text):
+        if m.start() > pos:
+            if '&' in text[pos : m.start()]:
+                return False
+            children.append(text[pos : m.start()])
+        dec, hexa, name = m.groups()
+        if name:
+            children.append(known_entities.get(name, '&%s;' % name))
+        else:
+            code = int(dec) if dec else int(hexa, 16)
+            if code > 0x10FFFF:
+                return False
+            children.append(chr(code))
+        pos = m.end()
+    if pos < len(text):
+        if '&' in text[pos:]:
+            return False
+        children.append(text[pos:])
+    return True
+
+
+def _tuple_tree(tokens):
+    root = ('para', {}, [])
+    stack = [root]
+    text = []
+    for t in tokens:
+        if t[0] != '<':
+            text.append(t)
+            continue
+        if text:
+            if not _data(''.join(text), stack[-1][2]):
+                return None
+            text = []
+        m = _tag.match(t)
+        if m is None:
+            return None
+        end, name, attrs, empty = m.groups()
+        name = name.lower()
+        if end:
+            if attrs or empty or len(stack) == 1 or stack[-1][0] != name:
+                return None
+            stack.pop()
+            continue
+        if name in _cdata_tags:
+            return None
+        d = {}
+        pos = 0
+        for a in _attr.finditer(attrs):
+            if a.start() != pos:
+                return None
+            value = a.group(2) if a.group(2) is not None else a.group(3)
+            d[a.group(1).lower()] = unescape(value) if value else value
+            pos = a.end()
+        if attrs[pos:].strip():
+            return None
+        node = (name, d, [])
+        stack[-1][2].append(node)
+        if not empty:
+            stack.append(node)
+    if text and not _data(''.join(text), stack[-1][2]):
+        return None
+    if len(stack) != 1:
+        return None
+    return root
+
+
+def paragraph_frags(tokens, style):
+    """Return (markup, frags) for a Paragraph built from tokens.
+
+    markup is the cleaned up text Paragraph would have kept, and
+    frags is None if the tokens have to be parsed as markup instead.
+    """
+    tokens = _clean(tokens)
+    markup = ''.join(tokens)
+    if _odd_space.search(markup) or markup.startswith('<para'):
+        return markup, None
+    tree = _tuple_tree(tokens)
+    if tree is None:
+        return markup, None
+    try:
+        style, frags, bullet_frags = ParaParser(caseSensitive=1).tt_parse(tree, style)
+    except ValueError:
+        return markup, None
+    if frags is None or bullet_frags:
+        return markup, None
+    textTransformFrags(frags, style)
+    return markup, frags
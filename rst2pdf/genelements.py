@@ -44,9 +44,11 @@ from .basenodehandler import NodeHandler
 from .directives.aafigure import Aanode
 from .directives.oddeven import OddEvenNode
 from .flowables import (
+    CachedParagraph,
     Table,
     DelayedTable,
     SplitTable,
+    ListItem,
     Heading,
     MyTableOfContents,
     MySpacer,
@@ -57,7 +59,9 @@ from .flowables import (
     OddEven,
     XPreformatted,
 )
+from .fragments import paragraph_frags
 from .math_flowable import Math
+from .orderedset import OrderedSet
 from .utils import parseRaw, parseHTML
 
 
@@ -179,7 +183,7 @@ class HandleTGroup(NodeHandler, docutils.nodes.tgroup):
                 st.add(*cmd)
         rtr = client.repeat_table_rows
 
-        t = DelayedTable(data, colWidths, st, rtr)
+        t = DelayedTable(data, colWidths, st, rtr, client=client)
         if style.alignment == TA_LEFT:
             t.hAlign = 'LEFT'
         elif style.alignment == TA_CENTER:
@@ -191,12 +195,19 @@ class HandleTGroup(NodeHandler, docutils.nodes.tgroup):
 
 class HandleParagraph(NodeHandler, docutils.nodes.paragraph):
     def gather_elements(self, client, node, style):
-        return [Paragraph(client.gen_pdftext(node), style)]
+        if client.inline_fragments:
+            text, frags = paragraph_frags(client.gen_pdftokens(node), style)
+        else:
+            text, frags = client.gen_pdftext(node), None
+        if client.paragraph_cache is not None:
+            return [CachedParagraph(text, style, frags=frags, client=client)]
+        return [Paragraph(text, style, frags=frags)]
 
     def get_pre_post(self, client, node, replaceEnt):
         pre = ''
-        targets = set(node.get('ids', []) + client.pending_targets)
-        client.pending_targets = []
+        targets = OrderedSet(node.get('ids', []))
+        targets.extend(client.pending_targets)
+        client.pending_targets = OrderedSet()
         for _id in targets:
             if _id not in client.targets:
                 pre += '<a name="%s"/>' % (_id)
@@ -302,6 +313,7 @@ class HandleField(NodeHandler, docutils.nodes.field):
                 [[fn, fb]],
                 colWidths=client.styles['field-list'].colWidths,
                 style=t_style,
+                client=client,
             )
         ]
 
@@ -380,7 +392,7 @@ class HandleAuthors(NodeHandler, docutils.nodes.authors):
                 client.gather_elements(node, style=style),
             ]
         ]
-        return [DelayedTable(td, colWidths=colWidths, style=t_style)]
+        return [DelayedTable(td, colWidths=colWidths, style=t_style, client=client)]
 
 
 class HandleFList(NodeHandler):
@@ -502,7 +514,12 @@ class HandleSection(NodeHandler, docutils.nodes.section):
     def gather_elements(self, client, node, style):
         # XXX: should style be passed down here?
         client.depth += 1
-        elements = client.gather_elements(node)
+        if client.flowable_cache is not None and client.depth == 1:
+            elements = client.flowable_cache.gather_elements(
+                client, node, lambda: client.gather_elements(node)
+            )
+        else:
+            elements = client.gather_elements(node)
         client.depth -= 1
         return elements
 
@@ -581,6 +598,7 @@ class HandleOptionListItem(NodeHandler, docutils.nodes.option_list_item):
                 [[client.PreformattedFit(optext, client.styles["literal"]), desc]],
                 colWidths=colWidths,
                 style=t_style,
+                client=client,
             )
         ]
         return node.elements
@@ -616,7 +634,7 @@ class HandleDefListItem(NodeHandler, docutils.nodes.definition_list_item):
                     ''.join(ids) + ' : '.join(tt),
                     client.styles['definition-list-term'],
                 ),
-                SplitTable([['', dt]], colWidths=cw, style=t_style),
+                SplitTable([['', dt]], colWidths=cw, style=t_style, client=client),
             ]
         else:
             node.elements = [
@@ -624,7 +642,9 @@ class HandleDefListItem(NodeHandler, docutils.nodes.definition_list_item):
                     ''.join(ids) + ' : '.join(tt),
                     client.styles['definition-list-term'],
                 ),
-                DelayedTable([['', dt]], colWidths=[10, None], style=t_style),
+                DelayedTable(
+                    [['', dt]], colWidths=[10, None], style=t_style, client=client
+                ),
             ]
 
         return node.elements
@@ -685,13 +705,28 @@ class HandleListItem(NodeHandler, docutils.nodes.list_item):
         while len(colWidths) < 2:
             colWidths.append(client.styles['item_list'].colWidths[len(colWidths)])
 
-        if client.splittables:
+        # Items laid out like the table below, without the table. Styles
+        # with other commands than paddings and alignments (like the grids
+        # in debugtables) need the real thing.
+        if ListItem.handles(el, colWidths, t_style):
+            node.elements = [
+                MySpacer(0, sb),
+                ListItem(
+                    Paragraph(b, style=bStyle),
+                    el,
+                    colWidths=colWidths,
+                    style=t_style,
+                    splittable=client.splittables,
+                ),
+            ]
+        elif client.splittables:
             node.elements = [
                 MySpacer(0, sb),
                 SplitTable(
                     [[Paragraph(b, style=bStyle), el]],
                     colWidths=colWidths,
                     style=t_style,
+                    client=client,
                 ),
             ]
         else:
@@ -701,6 +736,7 @@ class HandleListItem(NodeHandler, docutils.nodes.list_item):
                     [[Paragraph(b, style=bStyle), el]],
                     colWidths=colWidths,
                     style=t_style,
+                    client=client,
                 ),
             ]
         return node.elements
@@ -740,6 +776,7 @@ class HandleBlockQuote(NodeHandler, docutils.nodes.block_quote):
                             ["BOTTOMPADDING", [0, 0], [-1, -1], 0],
                         ]
                     ),
+                    client=client,
                 ),
                 MySpacer(0, spaceAfter),
             ]
@@ -757,6 +794,7 @@ class HandleBlockQuote(NodeHandler, docutils.nodes.block_quote):
                             ["BOTTOMPADDING", [0, 0], [-1, -1], 0],
                         ]
                     ),
+                    client=client,
                 ),
                 MySpacer(0, spaceAfter),
             ]
@@ -845,7 +883,9 @@ class HandleFigure(NodeHandler, docutils.nodes.figure):
         cw = [w]
         sub_elems = client.gather_elements(node, style=None)
         t_style = TableStyle(cmd)
-        table = DelayedTable([[e] for e in sub_elems], colWidths=cw, style=t_style)
+        table = DelayedTable(
+            [[e] for e in sub_elems], colWidths=cw, style=t_style, client=client
+        )
         table.hAlign = node.get('align', 'CENTER').upper()
         return [
             MySpacer(0, style.spaceBefore),
@@ -920,7 +960,7 @@ class HandleTBody(NodeHandler, docutils.nodes.tbody):
             t.append(r)
         t_style = TableStyle(client.styles['table'].commands)
         colWidths = client.styles['table'].colWidths
-        return [DelayedTable(t, colWidths=colWidths, style=t_style)]
+        return [DelayedTable(t, colWidths=colWidths, style=t_style, client=client)]
 
 
 class HandleFootnote(NodeHandler, docutils.nodes.footnote, docutils.nodes.citation):
@@ -969,7 +1009,12 @@ class HandleFootnote(NodeHandler, docutils.nodes.footnote, docutils.nodes.citati
             colWidths = client.styles['endnote'].colWidths
             node.elements = [
                 MySpacer(0, st.spaceBefore),
-                DelayedTable([[label, contents]], colWidths=colWidths, style=t_style),
+                DelayedTable(
+                    [[label, contents]],
+                    colWidths=colWidths,
+                    style=t_style,
+                    client=client,
+                ),
                 MySpacer(0, st.spaceAfter),
             ]
             if client.real_footnotes:
@@ -1078,6 +1123,7 @@ class HandleAdmonition(
                     colWidths=[0, None],
                     style=t_style,
                     padding=st.borderPadding,
+                    client=client,
                 ),
                 MySpacer(0, st.spaceAfter),
             ]
@@ -1089,7 +1135,9 @@ class HandleAdmonition(
             t_style.add(*p4)
             node.elements = [
                 MySpacer(0, st.spaceBefore),
-                DelayedTable([['', rows]], colWidths=[0, None], style=t_style),
+                DelayedTable(
+                    [['', rows]], colWidths=[0, None], style=t_style, client=client
+                ),
                 MySpacer(0, st.spaceAfter),
             ]
         return node.elements
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Find out which node handlers, and which parts of the source, make
+building the flowables slow.
+
+When a client has a handler_profile, NodeHandler.elemdispatch and
+tokendispatch (which textdispatch goes through) tell it when each
+handler starts and ends handling a node. It keeps, for each handler
+class, how many nodes it handled, its cumulative time, including the
+handlers it called for the children, and its self time, without them.
+The self time is also added up for each range of lines of each source
+file, so the constructs that take the time can be found in the source.
+'''
+
+from collections import Counter
+import json
+import time
+
+from docutils.utils import get_source_line
+
+
+class HandlerProfile(object):
+    def __init__(self, lines=50):
+        # The source is split in ranges of this many lines
+        self.lines = lines
+        # (handler, dispatch): [calls, cumulative, self]
+        self.handlers = {}
+        # (source, first line): [calls, self]
+        self.sources = {}
+        # Each handler running: [key, where, started, time in the handlers it called]
+        self._running = []
+        # How many times each handler is running, so the cumulative time
+        # of handlers that call themselves, like sections, is added once
+        self._depth = Counter()
+
+    def enter(self, handler, node, dispatch):
+        """handler starts handling node, in dispatch."""
+        key = (type(handler).__name__, dispatch)
+        source, line = get_source_line(node)
+        if line:
+            line = (line - 1) // self.lines * self.lines + 1
+        self._running.append([key, (source, line), time.perf_counter(), 0.0])
+        self._depth[key] += 1
+
+    def leave(self):
+        """The last handler that entered is done with its node."""
+        key, where, started, called = self._running.pop()
+        elapsed = time.perf_counter() - started
+        if self._running:
+            self._running[-1][3] += elapsed
+        self._depth[key] -= 1
+        stats = self.handlers.setdefault(key, [0, 0.0, 0.0])
+        stats[0] += 1
+        if not self._depth[key]:
+            stats[1] += elapsed
+        stats[2] += elapsed - called
+        stats = self.sources.setdefault(where, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed - called
+
+    def _lines(self, source, line):
+        # Like docutils, call what wasn't read from a file <string>
+        source = source or '<string>'
+        if not line:
+            return source
+        return '%s:%d-%d' % (source, line, line + self.lines - 1)
+
+    def report(self, format='text', limit=20):
+        """The handlers and the ranges of source lines, the slowest first,
+        as tables in text, with up to limit rows each, or as JSON."""
+        handlers = sorted(self.handlers.items(), key=lambda item: -item[1][2])
+        sources = sorted(self.sources.items(), key=lambda item: -item[1][1])
+        if format == 'json':
+            return json.dumps(
+                {
+                    'handlers': [
+                        {
+                            'handler': handler,
+                            'dispatch': dispatch,
+                            'calls': calls,
+                            'cumulative': cumulative,
+                            'self': own,
+                        }
+                        for (handler, dispatch), (calls, cumulative, own) in handlers
+                    ],
+                    'sources': [
+                        {'lines': self._lines(*where), 'calls': calls, 'self': own}
+                        for where, (calls, own) in sources
+                    ],
+                },
+                indent=1,
+            )
+        lines = [
+            '%-28s %-9s %8s %10s %9s'
+            % ('Handler', 'Dispatch', 'Calls', 'Cumul (s)', 'Self (s)')
+        ]
+        for (handler, dispatch), (calls, cumulative, own) in handlers[:limit]:
+            lines.append(
+                '%-28s %-9s %8d %10.3f %9.3f'
+                % (handler, dispatch, calls, cumulative, own)
+            )
+        lines.append('')
+        lines.append('%-48s %8s %9s' % ('Source lines', 'Calls', 'Self (s)'))
+        for where, (calls, own) in sources[:limit]:
+            lines.append('%-48s %8d %9.3f' % (self._lines(*where), calls, own))
+        return '\n'.join(lines)
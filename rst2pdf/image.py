@@ -210,6 +210,9 @@ class MyImage(Flowable):
 
             return filename, backend
 
+        if client.record_dependencies is not None:
+            client.record_dependencies.add(filename)
+
         if extension in ['svg', 'svgz']:
             if SVGImage is not None:
                 log.info('Backend for %s is SVGImage', filename)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Skip builds whose output is up to date, like make does.
+
+After a build, write_manifest keeps the digests of the files it used
+(the source, and whatever was recorded in record_dependencies:
+stylesheets, fonts, templates, included files and images) and of the
+path of the source and the options it was built with, in a file next to
+the output. up_to_date tells if none of those changed since.
+'''
+
+import hashlib
+import json
+import os
+
+from reportlab import Version as reportlab_version
+
+from . import version
+from .log import log
+
+# Options that don't change the output
+_NOT_OUTPUT = {
+    'infile',
+    'outfile',
+    'quiet',
+    'verbose',
+    'vverbose',
+    'record_dependencies',
+    'skip_unchanged',
+    'stream',
+    'profile_phases',
+    'profile_format',
+    'profile_handlers',
+    # The caches and the processes make the same output faster
+    'layout_jobs',
+    'doctree_cache',
+    'flowable_cache',
+    'layout_cache',
+}
+
+
+def manifest_path(output):
+    return output + '.deps.json'
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def options_digest(options, source):
+    """A digest of the versions of rst2pdf and reportlab, of the path of
+    the source and of the options that make a difference in the output."""
+    items = sorted(
+        (name, value)
+        for name, value in vars(options).items()
+        if name not in _NOT_OUTPUT
+    )
+    # The same output may be built from another source
+    source = os.path.abspath(source)
+    return hashlib.sha1(
+        repr((version, reportlab_version, source, items)).encode()
+    ).hexdigest()
+
+
+def up_to_date(output, options):
+    """True if output was built with the same options digest out of
+    files that didn't change since."""
+    if not os.path.exists(output):
+        return False
+    try:
+        with open(manifest_path(output), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('options') != options:
+        log.info('The options changed since the last build')
+        return False
+    for path, digest in manifest.get('files', {}).items():
+        if file_digest(path) != digest:
+            log.info('%s changed since the last build', path)
+            return False
+    return True
+
+
+def write_manifest(output, options, paths):
+    """Keep what up_to_date needs to know about output, built with the
+    options digest out of paths."""
+    files = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        digest = file_digest(path)
+        # Temporary files, like downloaded images, are gone by now
+        if digest is not None:
+            files[path] = digest
+    try:
+        with open(manifest_path(output), 'w', encoding='utf-8') as f:
+            json.dump({'options': options, 'files': files}, f, indent=1)
+    except OSError as e:
+        log.warning('Cannot write %s: %s', manifest_path(output), e)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+
+class OrderedSet(object):
+    """A collection of unique items, kept in the order they were added.
+
+    It has the list methods rst2pdf uses for its bookkeeping of anchors
+    (append, extend, in, iteration), so it can replace lists that are
+    only ever searched, but membership tests don't depend on its size.
+    Adding an item that is already there does nothing.
+    """
+
+    def __init__(self, items=()):
+        self._items = dict.fromkeys(items)
+
+    def append(self, item):
+        self._items[item] = None
+
+    def extend(self, items):
+        for item in items:
+            self._items[item] = None
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self._items))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Find out where the time and memory of a build go, phase by phase.
+
+A PhaseProfile records, for each phase of the builds of a client, how
+many times it ran, its wall and CPU time, and the peak of the memory
+traced by tracemalloc while it ran. Phases can run inside other phases,
+like the parsing of a header while the document is laid out, and their
+time is only counted in the innermost one, so the times add up to the
+whole build. The peak of a phase is the highest memory use while it
+ran, the phases inside it included.
+
+The code of each phase runs in phase(name), or is decorated with
+timed(name), which do nothing unless a profile is being recorded.
+Tracing memory makes builds a lot slower, so a profile made with
+memory=False only records the times.
+'''
+
+import contextlib
+import functools
+import json
+import time
+import tracemalloc
+
+# The profile being recorded, if any
+_current = None
+
+
+class PhaseProfile(object):
+    def __init__(self, memory=True):
+        self.memory = memory
+        # name: {'calls', 'wall', 'cpu', 'peak'}, in the order they ran
+        self.phases = {}
+        self._running = []
+        self._wall = self._cpu = 0.0
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Record the phases that run in this context, tracing memory
+        allocations meanwhile, if the profile records memory."""
+        global _current
+        previous = _current
+        tracing = not self.memory or tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        _current = self
+        try:
+            yield self
+        finally:
+            _current = previous
+            if not tracing:
+                tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record what the code in this context takes as phase name."""
+        self._switch()
+        self._running.append(name)
+        stats = self.phases.setdefault(
+            name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': 0}
+        )
+        stats['calls'] += 1
+        try:
+            yield
+        finally:
+            self._switch()
+            self._running.pop()
+
+    def _switch(self):
+        """Add what happened since the last switch to the phase running."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self._running:
+            stats = self.phases[self._running[-1]]
+            stats['wall'] += wall - self._wall
+            stats['cpu'] += cpu - self._cpu
+        if self.memory:
+            # The peak since the last switch was reached in every phase
+            # running, not just the innermost one
+            peak = tracemalloc.get_traced_memory()[1]
+            for name in self._running:
+                stats = self.phases[name]
+                stats['peak'] = max(stats['peak'], peak)
+            tracemalloc.reset_peak()
+        self._wall, self._cpu = wall, cpu
+
+    def report(self, format='text'):
+        """The phases recorded, as a table in text, or as JSON."""
+        if format == 'json':
+            return json.dumps(self.phases, indent=1)
+        lines = [
+            '%-20s %6s %9s %9s %10s'
+            % ('Phase', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak (MB)')
+        ]
+        for name, stats in self.phases.items():
+            lines.append(
+                '%-20s %6d %9.3f %9.3f %10.1f'
+                % (
+                    name,
+                    stats['calls'],
+                    stats['wall'],
+                    stats['cpu'],
+                    stats['peak'] / 1024.0**2,
+                )
+            )
+        lines.append(
+            '%-20s %6s %9.3f %9.3f'
+            % (
+                'Total',
+                '',
+                sum(stats['wall'] for stats in self.phases.values()),
+                sum(stats['cpu'] for stats in self.phases.values()),
+            )
+        )
+        return '\n'.join(lines)
+
+
+def phase(name):
+    """A context that records what its code takes as phase name, in the
+    profile being recorded, if any."""
+    if _current is None:
+        return contextlib.nullcontext()
+    return _current.phase(name)
+
+
+def timed(name):
+    """Decorator that records what the function takes as phase name."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def recorded(name):
+    """Decorator for methods of RstToPdf: if the client has a
+    phase_profile, record the phases the method runs in it, and the rest
+    of what it takes as phase name."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(client, *args, **kwargs):
+            profile = client.phase_profile
+            if profile is None:
+                return method(client, *args, **kwargs)
+            with profile.recording(), profile.phase(name):
+                return method(client, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
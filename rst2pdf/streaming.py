@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Build documents that need a single pass without keeping them in memory.
+
+Usually the whole doctree is turned into flowables before the build
+starts, and both stay in memory until it ends, since the build may need
+more than one pass. A document without tables of contents, total page
+counts or real footnotes is laid out in a single pass, so its top level
+sections can be turned into flowables as the build gets to them instead.
+The doctree lets go of each section and the build of each flowable once
+it's done with them, so only what is being laid out is in memory.
+'''
+
+import sys
+
+from docutils import nodes
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+# Where the doctree keeps its nodes besides its children. The transforms
+# are done with them by the time the flowables are made.
+_NODE_INDEXES = (
+    'ids',
+    'refnames',
+    'refids',
+    'footnote_refs',
+    'citation_refs',
+    'indirect_targets',
+    'autofootnotes',
+    'autofootnote_refs',
+    'symbol_footnotes',
+    'symbol_footnote_refs',
+    'footnotes',
+    'citations',
+    'parse_messages',
+    'transform_messages',
+)
+
+
+def why_not_stream(client, doctree):
+    """The reason doctree can't be built by client in a single pass, or
+    None if it can."""
+    if client.real_footnotes:
+        return 'real footnotes move flowables around after a first pass'
+    if client.sphinx:
+        return 'Sphinx builds its documents in its own way'
+    if client.floating_images:
+        return 'floating images wrap around the flowables that follow them'
+    for node in doctree.findall(nodes.topic):
+        if 'contents' in node['classes']:
+            return 'it has a table of contents'
+    texts = [str(client.header), str(client.footer)]
+    texts.extend(node.astext() for node in doctree.findall(nodes.decoration))
+    for template in client.styles.pageTemplates.values():
+        texts.append(str(template.get('defaultHeader', '')))
+        texts.append(str(template.get('defaultFooter', '')))
+    if any('###Total###' in text for text in texts):
+        return 'its headers or footers show the total page count'
+    return None
+
+
+def split_sections(doctree):
+    """Take the top level sections of doctree, and whatever follows
+    them, out of it, and return them. The doctree is of no use for
+    anything else afterwards.
+
+    The nodes keep pointing at their parent, so they are handled as
+    they were in the doctree, but the doctree doesn't keep them alive.
+    """
+    for i, node in enumerate(doctree.children):
+        if isinstance(node, nodes.section):
+            break
+    else:
+        return []
+    sections = doctree.children[i:]
+    del doctree.children[i:]
+    for name in _NODE_INDEXES:
+        index = getattr(doctree, name, None)
+        if index is not None:
+            index.clear()
+    # The cover, headers and footers use the substitutions, but not the
+    # sections they were defined in
+    for name, node in doctree.substitution_defs.items():
+        doctree.substitution_defs[name] = node.deepcopy()
+    return sections
+
+
+class Story(list):
+    """The flowables of a build, which takes more of them from an
+    iterator as the build uses them up.
+
+    The build only looks a few flowables ahead, to keep them together
+    with the ones that follow, so asking for its length takes enough of
+    them to have at least ahead ready, while there are more.
+    """
+
+    def __init__(self, elements, more, ahead=32):
+        list.__init__(self, elements)
+        self.more = more
+        self.ahead = ahead
+
+    def __len__(self):
+        while self.more is not None and list.__len__(self) < self.ahead:
+            try:
+                self.append(next(self.more))
+            except StopIteration:
+                self.more = None
+        return list.__len__(self)
+
+
+def peak_memory():
+    """The most memory this process used so far, in MB, or None where
+    it can't be told."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS tells bytes, the rest kB
+    return peak / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
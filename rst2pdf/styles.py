@@ -2,6 +2,7 @@
 # See LICENSE.txt for licensing terms
 
 from copy import copy
+import functools
 import os
 import os.path
 import sys
@@ -21,6 +22,7 @@ import yaml
 
 from . import findfonts
 from .log import log
+from .phases import phase, timed
 from .rson import loads as rson_loads
 
 unit_separator = re.compile('(-?[0-9.]*)')
@@ -270,9 +272,10 @@ class StyleSheet(object):
                             # to register the font under
                             filename = os.path.basename(variant)
                             if self.record_dependencies:
-                                self.record_dependencies.add(filename)
+                                self.record_dependencies.add(location)
                             fontname = str(filename.split('.')[0])
-                            pdfmetrics.registerFont(TTFont(fontname, location))
+                            with phase('fonts'):
+                                pdfmetrics.registerFont(TTFont(fontname, location))
                             log.info(
                                 'Registering font: %s from %s' % (fontname, location)
                             )
@@ -653,6 +656,7 @@ class StyleSheet(object):
             log.warning("Can't find stylesheet %s" % fn)
         return result
 
+    @timed('fonts')
     def findFont(self, fn):
         """Find the absolute font name for a given font filename.
 
@@ -768,12 +772,8 @@ def adjustUnits(v, total=None, dpi=300, default_unit='pt', emsize=10):
     if v is None or v == "":
         return None
 
-    v = str(v)
-    length = re.split(r'(-?[0-9.]+)', v)
-    n = length[1]
-    u = default_unit
-    if len(length) == 3 and length[2]:
-        u = length[2]
+    n, u = splitUnits(str(v))
+    u = u or default_unit
     if u in units.__dict__:
         return float(n) * units.__dict__[u]
     else:
@@ -795,6 +795,25 @@ def adjustUnits(v, total=None, dpi=300, default_unit='pt', emsize=10):
     return float(n)
 
 
+@functools.lru_cache(maxsize=1024)
+def splitUnits(v):
+    """Split a length like "2.5cm" into its number and its unit.
+
+    Lengths are parsed over and over (every table column on every wrap),
+    so results are cached. The unit is empty if there is none.
+
+    Example::
+
+            >>> splitUnits('50%')
+            ('50', '%')
+
+    """
+    length = re.split(r'(-?[0-9.]+)', v)
+    if len(length) == 3:
+        return length[1], length[2]
+    return length[1], ''
+
+
 def formatColor(value, numeric=True):
     """Convert a color like "gray" or "0xf" or "ffff"
     to something ReportLab will like."""
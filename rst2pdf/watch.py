@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# See LICENSE.txt for licensing terms
+
+'''
+Build a document again every time one of the files it uses changes.
+
+The files watched are the source and whatever the last build recorded
+in record_dependencies: included files, stylesheets, fonts, templates
+and images.
+
+The process and the RstToPdf client stay up between builds, so the
+stylesheet, the fonts it registered, the syntax highlighting lexers and
+whatever else is kept in memory are only loaded once. Only when a
+stylesheet or a font changes is a new client made.
+'''
+
+import time
+
+from .chapters import file_stamp
+from .log import log
+from .phases import PhaseProfile
+
+
+def _stamps(paths):
+    return {path: file_stamp(path) for path in paths}
+
+
+def _simple(value):
+    return isinstance(value, (bool, int, float, str, type(None)))
+
+
+def wait_for_changes(paths, interval=0.5, delay=0.3):
+    """Wait until some of paths change, and then until they stay the
+    same for delay seconds. Returns the paths that changed."""
+    stamps = _stamps(paths)
+    while True:
+        time.sleep(interval)
+        current = _stamps(paths)
+        if current != stamps:
+            break
+    # Editors often save in more than one step, wait for the last one
+    while True:
+        time.sleep(delay)
+        settled = _stamps(paths)
+        if settled == current:
+            break
+        current = settled
+    return {path for path in paths if current[path] != stamps[path]}
+
+
+class _Client(object):
+    """A client, and what it was like before its first build."""
+
+    def __init__(self, client):
+        self.client = client
+        self.state = dict(vars(client))
+        # What the stylesheets recorded when they were loaded
+        self.styles = list(client.record_dependencies.list)
+        # Only trace memory if asked to with --profile-phases
+        self.memory = client.phase_profile is not None
+
+    def reset(self):
+        """Put back the options a build may have changed, like toc_depth
+        or real_footnotes, and forget what the build recorded and how long
+        it took."""
+        client = self.client
+        for name, value in list(vars(client).items()):
+            if name not in self.state:
+                if _simple(value):
+                    delattr(client, name)
+            elif _simple(self.state[name]):
+                setattr(client, name, self.state[name])
+        client.record_dependencies.list[:] = self.styles
+        client.phase_profile = PhaseProfile(memory=self.memory)
+
+
+def watch(source, output, make_client, build, interval=0.5, delay=0.3):
+    """Build output out of source now and every time a file it uses
+    changes, until interrupted.
+
+    make_client() returns a new RstToPdf, and build(client) builds
+    output with it, returning what createPdf returns. Prints how long
+    each build took, and each of its phases.
+    """
+    current = None
+    paths = [source]
+    while True:
+        if current is None:
+            # Some errors, like a font that can't be found, exit
+            try:
+                current = _Client(make_client())
+            except (Exception, SystemExit):
+                log.exception('Cannot load the stylesheets')
+        if current is not None:
+            current.reset()
+            client = current.client
+            started = time.perf_counter()
+            try:
+                return_code = build(client)
+            except (Exception, SystemExit):
+                log.exception('Error building %s', output)
+                return_code = 1
+            if return_code == 0:
+                print(
+                    'Built %s in %.2fs (%s)'
+                    % (
+                        output,
+                        time.perf_counter() - started,
+                        ', '.join(
+                            '%s %.2fs' % (name, stats['wall'])
+                            for name, stats in client.phase_profile.phases.items()
+                        ),
+                    )
+                )
+            else:
+                print('Building %s failed' % output)
+            paths = [source] + client.record_dependencies.list
+        log.info('Watching %d files for changes', len(paths))
+        try:
+            changed = wait_for_changes(paths, interval, delay)
+        except KeyboardInterrupt:
+            return 0
+        print('Changed: %s' % ', '.join(sorted(changed)))
+        if current is not None and changed.intersection(current.styles):
+            current = None
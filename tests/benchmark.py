@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Time rst2pdf on generated documents that stress it.
+
+Usage: benchmark.py [name ...]
+
+Runs the named benchmarks, or all of them, and prints how long
+each one took. The PDFs are written to rst2pdf-benchmark in the
+temporary directory.
+
+inline-markup only builds the inline markup of ~10MB of prose, and
+compares it with the markup concatenated level by level, the way
+rst2pdf used to build it. many-targets only builds the flowables for
+a document with over 100k anchors. backgrounds also counts how many
+times its two background images are read, which should be once each.
+chapters builds ~50MB of chapters with and without --stream, each in
+its own process, and prints the peak memory use of both.
+"""
+
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import docutils.core
+import docutils.nodes
+
+from rst2pdf.basenodehandler import NodeHandler
+from rst2pdf.createpdf import RstToPdf
+from rst2pdf.dryrun import dry_run_layout
+from rst2pdf.image import MyImage
+from rst2pdf.nodehandlers import nodehandlers
+
+INPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input')
+OUTPUT_DIR = os.path.join(tempfile.gettempdir(), 'rst2pdf-benchmark')
+
+
+def nested_lists(counts=(10, 6, 6, 6, 8)):
+    """A bullet/enumerated list nested 5 levels deep, with ~20k items."""
+
+    def items(counts, indent, prefix, depth):
+        marker = '- ' if depth % 2 == 0 else '#. '
+        lines = []
+        for i in range(counts[0]):
+            label = '%s%d' % (prefix, i + 1)
+            text = 'Item %s at level %d, with a few more words.' % (label, depth + 1)
+            if i % 3 == 0:
+                text += ' Longer text to wrap over several lines of output.' * 4
+            lines.append(' ' * indent + marker + text)
+            if counts[1:]:
+                lines.append('')
+                lines.extend(
+                    items(counts[1:], indent + len(marker), label + '.', depth + 1)
+                )
+                lines.append('')
+        return lines
+
+    return 'Nested lists\n============\n\n' + '\n'.join(items(counts, 0, '', 0))
+
+
+def prose(size=10 * 1024 * 1024):
+    """About size bytes of paragraphs full of (nested) inline markup."""
+
+    rnd = random.Random(0)
+    words = (
+        'the of and to in is that it was for on are as with his they at be '
+        'this from have or by one had not but what all were when we there '
+        'can an your which their said if do will each about how up out them'
+    ).split()
+    markup = [
+        '*%s*',
+        '**%s**',
+        '``%s``',
+        '"%s"',
+        "'%s'",
+        '`%s <http://example.com/%s>`__',
+        ':sup:`%s`',
+        '*nested* **%s**',
+    ]
+    paragraphs = []
+    length = 0
+    while length < size:
+        text = []
+        for i in range(rnd.randint(40, 120)):
+            word = rnd.choice(words)
+            if rnd.random() < 0.15:
+                fmt = rnd.choice(markup)
+                word = fmt % ((word,) * fmt.count('%s'))
+            text.append(word)
+        paragraphs.append(' '.join(text) + '...')
+        length += len(paragraphs[-1]) + 2
+    return 'Prose\n=====\n\n' + '\n\n'.join(paragraphs)
+
+
+def many_targets(count=100000):
+    """count/2 short paragraphs, each with a target, a footnote and a
+    reference to another target: over count anchors in all."""
+    paragraphs = []
+    for i in range(0, count, 2):
+        paragraphs.append(
+            '.. _target-%d:\n\n'
+            'Paragraph %d [#]_ refers to target-%d_.\n\n'
+            '.. [#] Footnote %d.' % (i, i, max(i - 2, 0), i)
+        )
+    return 'Targets\n=======\n\n' + '\n\n'.join(paragraphs)
+
+
+def long_toc(count=5000):
+    """A table of contents with count entries, on two levels."""
+    sections = []
+    for i in range(count):
+        title = 'Section %d' % (i + 1)
+        underline = '=' if i % 5 == 0 else '-'
+        sections.append(
+            '%s\n%s\n\nSome text for section %d.'
+            % (title, underline * len(title), i + 1)
+        )
+    return '.. contents::\n\n' + '\n\n'.join(sections)
+
+
+def decorated_pages(count=1000):
+    """About count pages with the default header and footer of the
+    decoratedPage template."""
+    text = 'Some text for this section, long enough to wrap. ' * 12
+    sections = [
+        'Decorated pages\n===============',
+        '.. raw:: pdf\n\n   PageBreak decoratedPage',
+    ]
+    for i in range(count):
+        title = 'Section %d' % (i + 1)
+        sections.append('%s\n%s' % (title, '-' * len(title)))
+        sections.extend([text] * 6)
+    return '\n\n'.join(sections)
+
+
+def book(chapters=100):
+    """A table of contents and chapters of ~10 pages each."""
+    text = 'Some text for this section, long enough to wrap. ' * 12
+    parts = ['Book\n====', '.. contents::']
+    for i in range(chapters):
+        title = 'Chapter %d' % (i + 1)
+        parts.append('%s\n%s' % (title, '-' * len(title)))
+        for j in range(8):
+            title = 'Section %d.%d' % (i + 1, j + 1)
+            parts.append('%s\n%s' % (title, '~' * len(title)))
+            parts.extend([text] * 6)
+    return '\n\n'.join(parts)
+
+
+def chapters(size=50 * 1024 * 1024):
+    """About size bytes of chapters of ~10 pages each, with footnotes,
+    and no table of contents, so it can be streamed."""
+    text = 'Some text for this section, long enough to wrap. ' * 12
+    parts = ['Chapters\n========']
+    length = 0
+    i = 0
+    while length < size:
+        i += 1
+        title = 'Chapter %d' % i
+        parts.append('%s\n%s' % (title, '-' * len(title)))
+        for j in range(8):
+            title = 'Section %d.%d' % (i, j + 1)
+            parts.append('%s\n%s' % (title, '~' * len(title)))
+            parts.extend([text] * 5)
+            parts.append('See the note [#]_.\n\n.. [#] Note for %s.' % title)
+        length = sum(len(part) + 2 for part in parts)
+    return '\n\n'.join(parts)
+
+
+def backgrounds(count=500):
+    """count pages, alternating between a raster and an SVG background."""
+    images = [
+        os.path.join(INPUT_DIR, 'images', 'background.jpg'),
+        os.path.join(INPUT_DIR, 'background.svg'),
+    ]
+    pages = ['Backgrounds\n===========']
+    for i in range(count):
+        pages.append(
+            '.. raw:: pdf\n\n   PageBreak background=%s\n\nPage %d.'
+            % (images[i % 2], i + 1)
+        )
+    return '\n\n'.join(pages)
+
+
+def legacy_pdftext(client, node, replaceEnt=True):
+    """The markup for node, concatenated level by level as rst2pdf
+    used to build it."""
+    handler = nodehandlers.findsubclass(node, 'textdispatch')
+    pre, post = handler.get_pre_post(client, node, replaceEnt)
+    if type(handler).get_text is NodeHandler.get_text:
+        text = ''.join([legacy_pdftext(client, n, replaceEnt) for n in node.children])
+    else:
+        text = handler.get_text(client, node, replaceEnt)
+    text = pre + text + post
+    return handler.apply_replacements(text, client.smartypants_attributes, node)
+
+
+def render(name, text, **kwargs):
+    """Build a PDF out of text."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # splittables is what the command line uses by default
+    r2p = RstToPdf(splittables=True, **kwargs)
+    start = time.perf_counter()
+    r2p.createPdf(text=text, output=os.path.join(OUTPUT_DIR, name + '.pdf'))
+    print('%s: %.2fs' % (name, time.perf_counter() - start))
+
+
+def reserve_toc(name, text):
+    """Build a PDF out of text, first as usual, then laying out its
+    chapters beforehand to reserve its table of contents."""
+    render(name, text)
+    render(name + '-reserved', text, reserve_toc=True)
+
+
+def inline_markup(name, text):
+    """Build the inline markup of every paragraph in text, both in a
+    single pass and concatenated level by level."""
+    doctree = docutils.core.publish_doctree(text)
+    paragraphs = list(doctree.findall(docutils.nodes.paragraph))
+    results = {}
+    for label, build in (
+        ('single pass', lambda r2p, node: r2p.gen_pdftext(node)),
+        ('legacy', legacy_pdftext),
+    ):
+        # A fresh client each time, since building the markup for
+        # targets has side effects on it
+        r2p = RstToPdf()
+        start = time.perf_counter()
+        results[label] = [build(r2p, p) for p in paragraphs]
+        print('%s (%s): %.2fs' % (name, label, time.perf_counter() - start))
+    if results['single pass'] != results['legacy']:
+        print('%s: the markup built differs!' % name)
+
+
+def count_decodes(name, text):
+    """Build a PDF out of text, counting how many times images are read
+    to find out their size."""
+    size_for_node = MyImage.size_for_node
+    calls = []
+
+    def counting(node, client):
+        calls.append(node['uri'])
+        return size_for_node(node, client)
+
+    MyImage.size_for_node = staticmethod(counting)
+    try:
+        render(name, text)
+    finally:
+        MyImage.size_for_node = size_for_node
+    print(
+        '%s: %d images read for %d distinct ones' % (name, len(calls), len(set(calls)))
+    )
+
+
+def elements(name, text):
+    """Build the flowables for text, without laying them out."""
+    doctree = docutils.core.publish_doctree(text)
+    r2p = RstToPdf()
+    start = time.perf_counter()
+    r2p.gen_elements(doctree)
+    print('%s: %.2fs' % (name, time.perf_counter() - start))
+
+
+def parse(name, text):
+    """Parse text without a doctree cache, then twice with one."""
+    with tempfile.TemporaryDirectory() as directory:
+        for label, cache in (('none', None), ('cold', directory), ('warm', directory)):
+            r2p = RstToPdf(doctree_cache=cache)
+            start = time.perf_counter()
+            r2p.parse(text, None, {})
+            print('%s, %s cache: %.2fs' % (name, label, time.perf_counter() - start))
+
+
+def cached_elements(name, text):
+    """Build the flowables for text without a flowable cache, then
+    twice with one."""
+    with tempfile.TemporaryDirectory() as directory:
+        for label, cache in (('none', None), ('cold', directory), ('warm', directory)):
+            doctree = docutils.core.publish_doctree(text)
+            r2p = RstToPdf(flowable_cache=cache)
+            start = time.perf_counter()
+            r2p.gen_elements(doctree)
+            print('%s, %s cache: %.2fs' % (name, label, time.perf_counter() - start))
+
+
+def dry_run(name, text):
+    """Build a PDF out of text, then only lay it out."""
+    render(name, text)
+    r2p = RstToPdf(splittables=True, dry_run_layout=True)
+    start = time.perf_counter()
+    return_code, summary = dry_run_layout(r2p, text)
+    print(
+        '%s, dry run: %.2fs, %d pages'
+        % (name, time.perf_counter() - start, summary['pages'])
+    )
+
+
+def preview(name, text):
+    """Build a PDF out of text, then only its first 5 pages."""
+    render(name, text)
+    render(name + '-5', text, max_pages=5)
+
+
+def peak_memory_use(name, text):
+    """Build a PDF out of text as usual and streamed, each in its own
+    process, so their peak memory use can be told apart."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    source = os.path.join(OUTPUT_DIR, name + '.rst')
+    with open(source, 'w', encoding='utf-8') as f:
+        f.write(text)
+    for label, options in (('usual', []), ('stream', ['--stream'])):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-m', 'rst2pdf.createpdf', '-v', source]
+            + options
+            + ['-o', os.path.join(OUTPUT_DIR, '%s-%s.pdf' % (name, label))],
+            capture_output=True,
+            text=True,
+        )
+        peak = re.search(r'Peak memory use: (\d+) MB', result.stderr)
+        print(
+            '%s, %s: %.2fs, peak memory use %s MB'
+            % (
+                name,
+                label,
+                time.perf_counter() - start,
+                peak.group(1) if peak else '?',
+            )
+        )
+
+
+BENCHMARKS = {
+    'nested-lists': (nested_lists, render),
+    'inline-markup': (prose, inline_markup),
+    'many-targets': (many_targets, elements),
+    'long-toc': (long_toc, render),
+    'decorated-pages': (decorated_pages, render),
+    'backgrounds': (backgrounds, count_decodes),
+    'book': (book, reserve_toc),
+    'book-parse': (book, parse),
+    'book-elements': (book, cached_elements),
+    'book-dry-run': (book, dry_run),
+    'book-preview': (book, preview),
+    'chapters': (chapters, peak_memory_use),
+}
+
+
+def run(names):
+    for name in names:
+        make, bench = BENCHMARKS[name]
+        bench(name, make())
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:] or sorted(BENCHMARKS))
@@ -15,6 +15,11 @@ import tempfile
 
 from packaging import version
 import pytest
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.platypus.paragraph import Paragraph
+from reportlab.platypus.tables import TableStyle
+
+from rst2pdf.flowables import DelayedTable, SplitTable
 
 try:
     import fitz
@@ -436,4 +441,54 @@ def pytest_collect_file(file_path, parent):
         return SphinxFile.from_parent(parent=parent, path=file_path)
 
 
+@pytest.fixture
+def delayed_table():
+    """Make a DelayedTable of two columns, with a paragraph and a string
+    in each of its rows."""
+    style = ParagraphStyle('test')
+
+    def make(rows=200, repeatrows=1, client=None):
+        data = [[Paragraph('Row %d' % n, style), 'cell'] for n in range(rows)]
+        return DelayedTable(
+            data, colWidths=['50%', '50%'], repeatrows=repeatrows, client=client
+        )
+
+    return make
+
+
+@pytest.fixture
+def split_table():
+    """Make a SplitTable like a list item, with count paragraphs in its
+    second column."""
+    style = ParagraphStyle('test')
+
+    def make(count=100):
+        text = [
+            Paragraph('Paragraph %d of a long list item.' % n, style)
+            for n in range(count)
+        ]
+        return SplitTable([['*', text]], colWidths=[20, None], style=TableStyle([]))
+
+    return make
+
+
+@pytest.fixture
+def many_targets():
+    """Make a document of count/2 short paragraphs, each with a target, a
+    footnote and a reference to another target: over count anchors in
+    all."""
+
+    def make(count=1000):
+        paragraphs = []
+        for i in range(0, count, 2):
+            paragraphs.append(
+                '.. _target-%d:\n\n'
+                'Paragraph %d [#]_ refers to target-%d_.\n\n'
+                '.. [#] Footnote %d.' % (i, i, max(i - 2, 0), i)
+            )
+        return 'Targets\n=======\n\n' + '\n\n'.join(paragraphs)
+
+    return make
+
+
 collect_ignore = ['tests/input/*.py']
@@ -0,0 +1,32 @@
+"""
+Tests for page backgrounds.
+
+See LICENSE.txt for licensing terms
+"""
+
+from collections import Counter
+import os
+
+from rst2pdf.createpdf import RstToPdf
+from rst2pdf.image import MyImage
+
+ROOT_DIR = os.path.realpath(os.path.dirname(__file__))
+INPUT_DIR = os.path.join(ROOT_DIR, 'input')
+
+
+def test_backgrounds_read_once(tmp_path, monkeypatch):
+    size_for_node = MyImage.size_for_node
+    reads = Counter()
+
+    def counting(node, client):
+        reads[node['uri']] += 1
+        return size_for_node(node, client)
+
+    monkeypatch.setattr(MyImage, 'size_for_node', staticmethod(counting))
+    monkeypatch.chdir(INPUT_DIR)
+    with open('test_background_pages.rst', encoding='utf-8') as f:
+        text = f.read()
+    client = RstToPdf(stylesheets=['test_background_pages.yaml'], basedir=INPUT_DIR)
+    client.createPdf(text=text, output=str(tmp_path / 'output.pdf'))
+    # Four pages, three of them with the same background
+    assert reads == {'background.png': 1, 'images/background.jpg': 1}
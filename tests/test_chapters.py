@@ -0,0 +1,54 @@
+"""
+Tests for laying out chapters ahead of the build, for --reserve-toc.
+
+See LICENSE.txt for licensing terms
+"""
+
+import inspect
+import os
+
+import pytest
+from reportlab.platypus.doctemplate import BaseDocTemplate
+
+from rst2pdf import chapters
+from test_rebuilds import INPUT_DIR, build, read
+
+OPTIONS = ['--reserve-toc', '--break-level=1', '--break-side=odd']
+
+
+def test_serial_layout_is_the_default(tmp_path):
+    log = build('test_reserve_toc_chapters', tmp_path / 'out.pdf', *OPTIONS)
+    assert 'Laid out 7 of 7 chapters in 1 processes' in log
+    assert 'the build took 1 passes instead of 2, one saved' in log
+
+
+@pytest.mark.skipif(
+    chapters._fork_context() is None, reason='processes cannot be forked here'
+)
+def test_serial_and_forked_layouts_agree(tmp_path):
+    # Laying out in this process leaves the flowables as they were
+    build('test_reserve_toc_chapters', tmp_path / 'serial.pdf', *OPTIONS)
+    log = build(
+        'test_reserve_toc_chapters',
+        tmp_path / 'forked.pdf',
+        '--layout-jobs=2',
+        *OPTIONS,
+    )
+    assert 'in 2 processes' in log
+    assert read(tmp_path / 'serial.pdf') == read(tmp_path / 'forked.pdf')
+    reference = os.path.join(INPUT_DIR, '..', 'reference')
+    assert read(tmp_path / 'serial.pdf') == read(
+        os.path.join(reference, 'test_reserve_toc_chapters.pdf')
+    )
+
+
+def test_no_fork_on_macos(monkeypatch):
+    monkeypatch.setattr(chapters.sys, 'platform', 'darwin')
+    assert chapters._fork_context() is None
+
+
+def test_reportlab_records_edits():
+    # Laying out in this process undoes what reportlab changes through
+    # this hook, which isn't public
+    source = inspect.getsource(BaseDocTemplate.handle_keepWithNext)
+    assert '_multiBuildEdits' in source
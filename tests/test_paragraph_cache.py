@@ -0,0 +1,48 @@
+"""
+Tests for the paragraph wrap cache of --paragraph-cache-size.
+
+See LICENSE.txt for licensing terms
+"""
+
+from docutils.core import publish_doctree
+from reportlab.lib.styles import ParagraphStyle
+
+from rst2pdf.createpdf import RstToPdf
+from rst2pdf.flowables import CachedParagraph, WrapCache
+
+TEXT = 'The same words, wrapped in the same width. ' * 4
+
+
+def test_cache_is_kept_by_each_client():
+    first = RstToPdf(paragraph_cache_size=10)
+    second = RstToPdf(paragraph_cache_size=10)
+    assert first.paragraph_cache is not second.paragraph_cache
+
+
+def test_no_cache_makes_plain_paragraphs():
+    client = RstToPdf()
+    assert client.paragraph_cache is None
+    client.doctree = publish_doctree('Hello')
+    paragraphs = client.gather_elements(client.doctree)
+    assert paragraphs
+    assert not any(isinstance(e, CachedParagraph) for e in paragraphs)
+
+
+def test_hit_has_its_own_lines():
+    cache = WrapCache(10)
+
+    class Client(object):
+        paragraph_cache = cache
+
+    style = ParagraphStyle('test')
+    first = CachedParagraph(TEXT, style, client=Client())
+    second = CachedParagraph(TEXT, style, client=Client())
+    assert first.wrap(100, 1000) == second.wrap(100, 1000)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert second.blPara is not first.blPara
+    assert second.blPara.lines is not first.blPara.lines
+    # Drawing or splitting one changes its lines, not the other's
+    second.blPara.lines[0][1].append('changed')
+    assert 'changed' not in first.blPara.lines[0][1]
+    assert first.split(100, first.height / 2)
+    assert second.wrap(100, 1000) == first.wrap(100, 1000)
@@ -0,0 +1,22 @@
+"""
+Tests for the phase profile of --profile-phases.
+
+See LICENSE.txt for licensing terms
+"""
+
+from rst2pdf.phases import PhaseProfile
+
+
+def test_nested_phase_keeps_outer_peak():
+    profile = PhaseProfile()
+    with profile.recording():
+        with profile.phase('outer'):
+            with profile.phase('inner'):
+                data = bytearray(8 * 1024 * 1024)
+                del data
+            # The outer phase's own allocations stay small
+            small = bytearray(1024)
+            del small
+    phases = profile.phases
+    assert phases['inner']['peak'] >= 8 * 1024 * 1024
+    assert phases['outer']['peak'] >= phases['inner']['peak']
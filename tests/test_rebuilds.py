@@ -0,0 +1,113 @@
+"""
+Tests for building the same document again, with the caches that make
+rebuilds faster.
+
+See LICENSE.txt for licensing terms
+"""
+
+import os
+import shutil
+import subprocess
+
+ROOT_DIR = os.path.realpath(os.path.dirname(__file__))
+INPUT_DIR = os.path.join(ROOT_DIR, 'input')
+
+
+def build(name, output, *options, directory=INPUT_DIR):
+    """Build name.rst in directory into output, and return what was
+    logged."""
+    cmd = ['rst2pdf', '--lang', 'en', '--date-invariant', '-v', name + '.rst']
+    cmd += list(options) + ['-o', str(output)]
+    return subprocess.check_output(
+        cmd, cwd=directory, stderr=subprocess.STDOUT, text=True
+    )
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_layout_cache(tmp_path):
+    options = [
+        '--reserve-toc',
+        '--layout-cache=%s' % (tmp_path / 'layout.json'),
+        '--break-level=1',
+    ]
+    log = build('test_layout_cache', tmp_path / 'first.pdf', *options)
+    assert 'Laid out 5 of 5 chapters' in log
+    log = build('test_layout_cache', tmp_path / 'second.pdf', *options)
+    assert 'Laid out 0 of 5 chapters' in log
+    assert read(tmp_path / 'first.pdf') == read(tmp_path / 'second.pdf')
+
+
+def test_layout_cache_follows_contents(tmp_path):
+    for name in ('test_layout_cache.rst', 'thanks.png', 'blue_text.yaml'):
+        shutil.copy(os.path.join(INPUT_DIR, name), tmp_path)
+    options = [
+        '--reserve-toc',
+        '--layout-cache=layout.json',
+        '--break-level=1',
+        '--stylesheets=blue_text.yaml',
+    ]
+    output = tmp_path / 'output.pdf'
+    build('test_layout_cache', output, *options, directory=tmp_path)
+    # Touched, but the same
+    stylesheet = tmp_path / 'blue_text.yaml'
+    stat = os.stat(stylesheet)
+    os.utime(stylesheet, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+    log = build('test_layout_cache', output, *options, directory=tmp_path)
+    assert 'Laid out 0 of 5 chapters' in log
+    with open(stylesheet, 'a') as f:
+        f.write('# changed\n')
+    log = build('test_layout_cache', output, *options, directory=tmp_path)
+    assert 'Laid out 5 of 5 chapters' in log
+
+
+def test_doctree_cache(tmp_path):
+    option = '--doctree-cache=%s' % (tmp_path / 'doctrees')
+    log = build('test_doctree_cache', tmp_path / 'first.pdf', option)
+    assert 'Using cached doctree' not in log
+    log = build('test_doctree_cache', tmp_path / 'second.pdf', option)
+    assert 'Using cached doctree' in log
+    assert read(tmp_path / 'first.pdf') == read(tmp_path / 'second.pdf')
+
+
+def test_flowable_cache(tmp_path):
+    option = '--flowable-cache=%s' % (tmp_path / 'flowables')
+    log = build('test_flowable_cache', tmp_path / 'first.pdf', option)
+    assert 'Took the flowables of 0 of 3 sections from the cache' in log
+    log = build('test_flowable_cache', tmp_path / 'second.pdf', option)
+    assert 'Took the flowables of 3 of 3 sections from the cache' in log
+    assert read(tmp_path / 'first.pdf') == read(tmp_path / 'second.pdf')
+
+
+def test_skip_unchanged(tmp_path):
+    for name in ('test_skip_unchanged.rst', 'thanks.png'):
+        shutil.copy(os.path.join(INPUT_DIR, name), tmp_path)
+    output = tmp_path / 'output.pdf'
+    log = build('test_skip_unchanged', output, '--skip-unchanged', directory=tmp_path)
+    assert 'is up to date' not in log
+    log = build('test_skip_unchanged', output, '--skip-unchanged', directory=tmp_path)
+    assert '%s is up to date' % output in log
+    # What the files have in them tells if they changed, not their times
+    shutil.copy(os.path.join(INPUT_DIR, 'background.png'), tmp_path / 'thanks.png')
+    log = build('test_skip_unchanged', output, '--skip-unchanged', directory=tmp_path)
+    assert 'thanks.png changed since the last build' in log
+    assert 'is up to date' not in log
+    # Nor do the caches change the output
+    options = ['--skip-unchanged', '--flowable-cache=%s' % (tmp_path / 'flowables')]
+    log = build('test_skip_unchanged', output, *options, directory=tmp_path)
+    assert '%s is up to date' % output in log
+
+
+def test_skip_unchanged_other_source(tmp_path):
+    for name in ('test_skip_unchanged.rst', 'test_max_pages.rst', 'thanks.png'):
+        shutil.copy(os.path.join(INPUT_DIR, name), tmp_path)
+    output = tmp_path / 'output.pdf'
+    build('test_skip_unchanged', output, '--skip-unchanged', directory=tmp_path)
+    first = read(output)
+    # Another source into the same output is built
+    log = build('test_max_pages', output, '--skip-unchanged', directory=tmp_path)
+    assert 'is up to date' not in log
+    assert read(output) != first
@@ -0,0 +1,53 @@
+"""
+Tests for the parts of reportlab that aren't public, which long tables
+and list items use when reportlab has them.
+
+See LICENSE.txt for licensing terms
+"""
+
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.platypus.paragraph import Paragraph
+from reportlab.platypus.tables import Table, TableStyle
+
+from rst2pdf import flowables
+from rst2pdf.flowables import ListItem
+
+STYLE = ParagraphStyle('test')
+
+
+def test_reportlab_has_them():
+    # Without them the build still works, only slower, so tell when a
+    # new reportlab drops them
+    table = Table([['a', 'b']])
+    missing = [n for n in flowables._WINDOW_INTERNALS if not hasattr(table, n)]
+    assert not missing
+    assert flowables._setCellStyle is not None
+    assert flowables.CellStyle is not None
+
+
+def test_long_table_without_them(monkeypatch, delayed_table):
+    monkeypatch.setattr(
+        flowables, '_WINDOW_INTERNALS', flowables._WINDOW_INTERNALS + ('_gone',)
+    )
+    table = delayed_table()
+    table.wrap(400, 500)
+    # The whole table, as reportlab lays it out
+    assert table._layout is None
+    assert table.t._nrows == 200
+    first, rest = table.split(400, 500)
+    assert first.wrap(400, 500)[1] <= 500
+    assert first._nrows + rest._nrows == 200 + 1
+
+
+def test_long_table_with_them(delayed_table):
+    table = delayed_table()
+    table.wrap(400, 500)
+    assert table._layout is not None
+
+
+def test_list_item_without_them(monkeypatch):
+    style = TableStyle([])
+    content = [Paragraph('Item', STYLE)]
+    assert ListItem.handles(content, [20, None], style)
+    monkeypatch.setattr(flowables, '_setCellStyle', None)
+    assert not ListItem.handles(content, [20, None], style)
@@ -0,0 +1,25 @@
+"""
+Tests for SplitTable, which splits the content of its second column.
+
+See LICENSE.txt for licensing terms
+"""
+
+from rst2pdf.flowables import SplitTable
+
+
+def test_wrap_is_the_whole_height(split_table):
+    table = split_table()
+    w, h = table.wrap(400, 100)
+    assert h > 1000
+    # The table is there to be drawn, or split
+    assert table.t is not None
+    assert (w, h) == split_table().wrap(400, 10000)
+
+
+def test_split_fits(split_table):
+    table = split_table()
+    table.wrap(400, 100)
+    first, rest = table.split(400, 100)
+    assert first.wrap(400, 100)[1] <= 100
+    assert isinstance(rest, SplitTable)
+    assert len(rest.data[0][1]) < 100
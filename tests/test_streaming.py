@@ -0,0 +1,54 @@
+"""
+Tests for the streamed builds of --stream.
+
+See LICENSE.txt for licensing terms
+"""
+
+from io import BytesIO
+
+from docutils.core import publish_doctree
+
+from rst2pdf import streaming
+from rst2pdf.createpdf import RstToPdf
+
+TEXT = '''
+Intro.
+
+First
+=====
+
+Text.
+
+Second
+======
+
+More text.
+'''
+
+
+def test_given_doctree_is_left_alone():
+    doctree = publish_doctree(TEXT)
+    children, ids = len(doctree.children), len(doctree.ids)
+    client = RstToPdf(stream=True)
+    assert client.createPdf(doctree=doctree, output=BytesIO()) == 0
+    assert len(doctree.children) == children
+    assert len(doctree.ids) == ids
+
+
+def test_peak_memory_units(monkeypatch):
+    class Usage(object):
+        ru_maxrss = 200 * 1024**2
+
+    class Resource(object):
+        RUSAGE_SELF = 0
+
+        @staticmethod
+        def getrusage(who):
+            return Usage()
+
+    monkeypatch.setattr(streaming, 'resource', Resource)
+    # In bytes on macOS, in kB elsewhere
+    monkeypatch.setattr(streaming.sys, 'platform', 'darwin')
+    assert streaming.peak_memory() == 200
+    monkeypatch.setattr(streaming.sys, 'platform', 'linux')
+    assert streaming.peak_memory() == 200 * 1024
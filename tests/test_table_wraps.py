@@ -0,0 +1,40 @@
+"""
+Tests for reusing the Table a DelayedTable built for the same size.
+
+See LICENSE.txt for licensing terms
+"""
+
+from reportlab.platypus.tables import TableStyle
+
+from rst2pdf.createpdf import RstToPdf
+
+
+def test_stats_are_kept_by_each_client(delayed_table):
+    first, second = RstToPdf(), RstToPdf()
+    table = delayed_table(10, client=first)
+    table.wrap(400, 500)
+    table.wrap(400, 500)
+    assert first.table_wrap_stats == {'hits': 1, 'misses': 1}
+    assert second.table_wrap_stats == {'hits': 0, 'misses': 0}
+
+
+def test_changed_rows_build_another_table(delayed_table):
+    client = RstToPdf()
+    table = delayed_table(10, client=client)
+    table.wrap(400, 500)
+    built = table.t
+    table.data[0] = ['A much longer first cell, which changes the table', 'cell']
+    table.wrap(400, 500)
+    assert table.t is not built
+    assert client.table_wrap_stats == {'hits': 0, 'misses': 2}
+
+
+def test_changed_style_builds_another_table(delayed_table):
+    client = RstToPdf()
+    table = delayed_table(10, client=client)
+    table.style = TableStyle([])
+    table.wrap(400, 500)
+    built = table.t
+    table.style.add('LEFTPADDING', (0, 0), (-1, -1), 20)
+    table.wrap(400, 500)
+    assert table.t is not built
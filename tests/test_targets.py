@@ -0,0 +1,39 @@
+"""
+Tests for the bookkeeping of anchors.
+
+See LICENSE.txt for licensing terms
+"""
+
+import docutils.core
+
+from rst2pdf.createpdf import RstToPdf
+from rst2pdf.orderedset import OrderedSet
+
+
+class CountingSet(OrderedSet):
+    """An OrderedSet that counts how many times it's searched and how
+    many times it's gone through."""
+
+    lookups = scans = 0
+
+    def __contains__(self, item):
+        self.lookups += 1
+        return super().__contains__(item)
+
+    def __iter__(self):
+        self.scans += 1
+        return super().__iter__()
+
+
+def test_targets_are_looked_up_not_scanned(many_targets):
+    doctree = docutils.core.publish_doctree(many_targets(1000))
+    client = RstToPdf()
+    client.targets = CountingSet()
+    client.gen_elements(doctree)
+    # The targets, the footnotes and their back references
+    assert len(client.targets) >= 1000
+    # Finding out whether an anchor is there already is a dict lookup,
+    # which doesn't depend on how many there are
+    assert client.targets.lookups >= 1000
+    assert client.targets.scans == 0
+    assert isinstance(client.pending_targets, OrderedSet)